@@ -3,6 +3,7 @@ ImageNet Latent Dataset with safetensors.
 """
 
 import os
+import multiprocessing
 import numpy as np
 from glob import glob
 from tqdm import tqdm
@@ -12,79 +13,172 @@ from torch.utils.data import Dataset
 
 from safetensors import safe_open
 
+from datasets.shard_cache import ShardCache
+from datasets.latent_stats import LatentStats, compute_shard_stats
+
 
 class ImgLatentDataset(Dataset):
-    def __init__(self, data_dir, latent_norm=True, latent_multiplier=1.0):
+    def __init__(self, data_dir, latent_norm=True, latent_multiplier=1.0, max_open_files=64, files=None):
         self.data_dir = data_dir
         self.latent_norm = latent_norm
         self.latent_multiplier = latent_multiplier
+        # memory-mapped shard handles, opened lazily in every DataLoader worker
+        self.shards = ShardCache(max_open_files=max_open_files)
 
-        self.files = sorted(glob(os.path.join(data_dir, "*.safetensors")))
-        self.img_to_file_map = self.get_img_to_safefile_map()
+        # shards can be given explicitly, e.g. from the extraction manifests
+        self.files = sorted(files) if files is not None else sorted(glob(os.path.join(data_dir, "*.safetensors")))
+        # cumulative image counts of the shards, image idx lives in shard i iff offsets[i] <= idx < offsets[i+1]
+        self.file_offsets = self.get_file_offsets()
         
         if latent_norm:
             self._latent_mean, self._latent_std = self.get_latent_stats()
 
-    def get_img_to_safefile_map(self):
-        img_to_file = {}
-        for safe_file in self.files:
-            with safe_open(safe_file, framework="pt", device="cpu") as f:
-                labels = f.get_slice('labels')
-                labels_shape = labels.get_shape()
-                num_imgs = labels_shape[0]
-                cur_len = len(img_to_file)
-                for i in range(num_imgs):
-                    img_to_file[cur_len+i] = {
-                        'safe_file': safe_file,
-                        'idx_in_file': i
-                    }
-        return img_to_file
+    def get_file_offsets(self):
+        """
+        Load the shard index from index.npy, or build it if the shard set changed.
+        The index is a structured array with the name, byte size and image count of every shard.
+        """
+        index_cache_file = os.path.join(self.data_dir, "index.npy")
+        names = [os.path.basename(safe_file) for safe_file in self.files]
+        sizes = [os.path.getsize(safe_file) for safe_file in self.files]
+
+        index = None
+        if os.path.exists(index_cache_file):
+            index = np.load(index_cache_file)
+            if index['name'].tolist() != names or index['size'].tolist() != sizes:
+                index = None
+        if index is None:
+            counts = []
+            for safe_file in self.files:
+                with safe_open(safe_file, framework="pt", device="cpu") as f:
+                    counts.append(f.get_slice('labels').get_shape()[0])
+            max_name_len = max([len(name) for name in names] + [1])
+            index = np.zeros(len(names), dtype=[('name', f'U{max_name_len}'), ('size', np.int64), ('count', np.int64)])
+            index['name'] = names
+            index['size'] = sizes
+            index['count'] = counts
+            if len(names) > 0:
+                # write atomically, several ranks may build the index at the same time
+                tmp_file = f"{index_cache_file}.{os.getpid()}.tmp"
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, index)
+                os.replace(tmp_file, index_cache_file)
+
+        return np.concatenate([[0], np.cumsum(index['count'])]).astype(np.int64)
+
+    def locate(self, idx):
+        """
+        Map a global image index to (safe_file, idx_in_file).
+        """
+        file_idx = int(np.searchsorted(self.file_offsets, idx, side='right')) - 1
+        return self.files[file_idx], int(idx - self.file_offsets[file_idx])
 
     def get_latent_stats(self):
         latent_stats_cache_file = os.path.join(self.data_dir, "latents_stats.pt")
-        if not os.path.exists(latent_stats_cache_file):
-            latent_stats = self.compute_latent_stats()
-            torch.save(latent_stats, latent_stats_cache_file)
-        else:
-            latent_stats = torch.load(latent_stats_cache_file)
+        shard_stats_cache_file = os.path.join(self.data_dir, "latents_stats_shards.pt")
+        if os.path.exists(latent_stats_cache_file):
+            # cached stats are outdated only if the shard set changed since the per-shard partials were stored
+            outdated = False
+            if len(self.files) > 0 and os.path.exists(shard_stats_cache_file):
+                shard_sizes = {name: partial['size'] for name, partial in torch.load(shard_stats_cache_file).items()}
+                outdated = shard_sizes != {os.path.basename(f): os.path.getsize(f) for f in self.files}
+            if not outdated:
+                latent_stats = torch.load(latent_stats_cache_file)
+                return latent_stats['mean'], latent_stats['std']
+        latent_stats = self.compute_latent_stats()
+        torch.save(latent_stats, latent_stats_cache_file)
         return latent_stats['mean'], latent_stats['std']
     
-    def compute_latent_stats(self):
-        num_samples = min(10000, len(self.img_to_file_map))
-        random_indices = np.random.choice(len(self.img_to_file_map), num_samples, replace=False)
-        latents = []
-        for idx in tqdm(random_indices):
-            img_info = self.img_to_file_map[idx]
-            safe_file, img_idx = img_info['safe_file'], img_info['idx_in_file']
-            with safe_open(safe_file, framework="pt", device="cpu") as f:
-                features = f.get_slice('latents')
-                feature = features[img_idx:img_idx+1]
-                latents.append(feature)
-        latents = torch.cat(latents, dim=0)
-        mean = latents.mean(dim=[0, 2, 3], keepdim=True)
-        std = latents.std(dim=[0, 2, 3], keepdim=True)
-        latent_stats = {'mean': mean, 'std': std}
+    def compute_latent_stats(self, num_workers=8):
+        """
+        Exact channel-wise statistics over all shards, merged from per-shard partials.
+        Partials are taken from the shard metadata (written by extract_features.py) or computed
+        in worker processes, and cached in latents_stats_shards.pt so new shards only add their own pass.
+        """
+        shard_stats_cache_file = os.path.join(self.data_dir, "latents_stats_shards.pt")
+        partials = torch.load(shard_stats_cache_file) if os.path.exists(shard_stats_cache_file) else {}
+        sizes = {os.path.basename(f): os.path.getsize(f) for f in self.files}
+        partials = {name: partial for name, partial in partials.items() if sizes.get(name) == partial['size']}
+
+        missing = []
+        for safe_file in self.files:
+            name = os.path.basename(safe_file)
+            if name in partials:
+                continue
+            metadata = self.shards.get(safe_file).metadata or {}
+            if 'latent_stats' in metadata:
+                stats = LatentStats.from_metadata(metadata['latent_stats'])
+                partials[name] = dict(size=sizes[name], **stats.state_dict())
+            else:
+                missing.append(safe_file)
+
+        if len(missing) > 0:
+            with multiprocessing.Pool(min(num_workers, len(missing))) as pool:
+                shard_stats = pool.imap(compute_shard_stats, missing)
+                for safe_file, stats in tqdm(zip(missing, shard_stats), total=len(missing), desc="Computing latent stats"):
+                    name = os.path.basename(safe_file)
+                    partials[name] = dict(size=sizes[name], **stats.state_dict())
+
+        tmp_file = f"{shard_stats_cache_file}.{os.getpid()}.tmp"
+        torch.save(partials, tmp_file)
+        os.replace(tmp_file, shard_stats_cache_file)
+
+        stats = LatentStats()
+        for name in sorted(partials.keys()):
+            stats.merge(LatentStats.from_state_dict(partials[name]))
+        latent_stats = stats.get_stats()
         print(latent_stats)
         return latent_stats
 
     def __len__(self):
-        return len(self.img_to_file_map.keys())
+        return int(self.file_offsets[-1])
 
     def __getitem__(self, idx):
-        img_info = self.img_to_file_map[idx]
-        safe_file, img_idx = img_info['safe_file'], img_info['idx_in_file']
-        with safe_open(safe_file, framework="pt", device="cpu") as f:
-            tensor_key = "latents" if np.random.uniform(0, 1) > 0.5 else "latents_flip"
-            features = f.get_slice(tensor_key)
-            labels = f.get_slice('labels')
-            feature = features[img_idx:img_idx+1]
-            label = labels[img_idx:img_idx+1]
+        safe_file, img_idx = self.locate(idx)
+        shard = self.shards.get(safe_file)
+        tensor_key = "latents" if np.random.uniform(0, 1) > 0.5 else "latents_flip"
+        feature = shard.rows(tensor_key, img_idx, img_idx+1)
+        label = shard.rows('labels', img_idx, img_idx+1)
 
         if self.latent_norm:
             feature = (feature - self._latent_mean) / self._latent_std
         feature = feature * self.latent_multiplier
         
-        # remove the first batch dimension (=1) kept by get_slice()
+        # remove the first batch dimension (=1) kept by rows()
         feature = feature.squeeze(0)
         label = label.squeeze(0)
-        return feature, label
\ No newline at end of file
+        return feature, label
+
+    def __getitems__(self, indices):
+        """
+        Batched __getitem__ used by the DataLoader fetcher.
+        Consecutive indices of the same shard (e.g. from ShardBlockSampler) are read as one contiguous run.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        file_ids = np.searchsorted(self.file_offsets, indices, side='right') - 1
+        # split into runs of consecutive indices within one shard
+        breaks = np.flatnonzero((np.diff(indices) != 1) | (np.diff(file_ids) != 0)) + 1
+        run_starts = np.concatenate([[0], breaks])
+        run_stops = np.concatenate([breaks, [len(indices)]])
+
+        samples = []
+        for run_start, run_stop in zip(run_starts, run_stops):
+            file_idx = file_ids[run_start]
+            shard = self.shards.get(self.files[file_idx])
+            start = int(indices[run_start] - self.file_offsets[file_idx])
+            stop = start + int(run_stop - run_start)
+
+            # per-sample flip choice, each row is read from exactly one of the two tensors
+            use_flip = torch.from_numpy(np.random.uniform(0, 1, size=stop - start) <= 0.5)
+            latents = shard.rows('latents', start, stop)
+            latents_flip = shard.rows('latents_flip', start, stop)
+            feature = torch.empty_like(latents)
+            feature[~use_flip] = latents[~use_flip]
+            feature[use_flip] = latents_flip[use_flip]
+            label = shard.rows('labels', start, stop)
+
+            if self.latent_norm:
+                feature = (feature - self._latent_mean) / self._latent_std
+            feature = feature * self.latent_multiplier
+            samples.extend(zip(feature.unbind(0), label.unbind(0)))
+        return samples
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""
+Streaming channel-wise latent statistics.
+"""
+
+import json
+
+import torch
+from safetensors import safe_open
+
+
+class LatentStats:
+    """
+    Channel-wise mean / variance accumulator of (N, C, H, W) latents (Welford / Chan et al.).
+    Partial statistics, e.g. of single shards, merge exactly into the statistics of their union.
+    """
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = mean  # (C,) float64
+        self.m2 = m2      # (C,) float64, sum of squared deviations from the mean
+
+    def update(self, latents):
+        """
+        Accumulate a batch of latents (N, C, H, W).
+        """
+        latents = latents.detach().to('cpu', dtype=torch.float64)
+        count = latents.shape[0] * latents.shape[2] * latents.shape[3]
+        if count == 0:
+            return self
+        mean = latents.mean(dim=[0, 2, 3])
+        m2 = ((latents - mean.view(1, -1, 1, 1)) ** 2).sum(dim=[0, 2, 3])
+        return self.merge(LatentStats(count, mean, m2))
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator into this one.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.clone(), other.m2.clone()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def get_stats(self):
+        """
+        Returns:
+            {'mean': (1, C, 1, 1), 'std': (1, C, 1, 1)} float32, std is unbiased like torch.std
+        """
+        std = torch.sqrt(self.m2 / (self.count - 1))
+        return {
+            'mean': self.mean.float().view(1, -1, 1, 1),
+            'std': std.float().view(1, -1, 1, 1),
+        }
+
+    def state_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        return cls(state_dict['count'], state_dict['mean'], state_dict['m2'])
+
+    def to_metadata(self):
+        """
+        Serialize to a string, e.g. for the metadata of a safetensors shard.
+        """
+        return json.dumps({'count': self.count, 'mean': self.mean.tolist(), 'm2': self.m2.tolist()})
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        state = json.loads(metadata)
+        return cls(
+            state['count'],
+            torch.tensor(state['mean'], dtype=torch.float64),
+            torch.tensor(state['m2'], dtype=torch.float64),
+        )
+
+
+def compute_shard_stats(safe_file, tensor_key='latents', chunk_size=1000):
+    """
+    Statistics of one whole shard, read in chunks of rows.
+    Top-level so that it can be mapped over shards by worker processes.
+    """
+    stats = LatentStats()
+    with safe_open(safe_file, framework="pt", device="cpu") as f:
+        features = f.get_slice(tensor_key)
+        num_imgs = features.get_shape()[0]
+        for start in range(0, num_imgs, chunk_size):
+            stats.update(features[start:min(start + chunk_size, num_imgs)])
+    return stats
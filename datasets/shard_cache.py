@@ -0,0 +1,111 @@
+"""
+Memory-mapped safetensors shards with an LRU cache of open handles.
+"""
+
+import os
+import json
+import math
+import mmap
+import struct
+from collections import OrderedDict
+
+import torch
+
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+class MmapShard:
+    """
+    A safetensors file mapped into memory once.
+    The header is parsed at open time, rows are returned as zero-copy views of the mapping.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            # copy-on-write mapping: the file is never modified and torch.frombuffer gets a writable buffer
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        header_len = struct.unpack('<Q', self._mmap[:8])[0]
+        header = json.loads(self._mmap[8:8 + header_len])
+        self.metadata = header.pop('__metadata__', None)
+        data_start = 8 + header_len
+
+        # name -> (dtype, shape, byte offset of the first row, bytes per row)
+        self.tensors = {}
+        for name, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info['dtype']]
+            shape = info['shape']
+            begin, _ = info['data_offsets']
+            row_bytes = math.prod(shape[1:]) * torch.empty(0, dtype=dtype).element_size()
+            self.tensors[name] = (dtype, shape, data_start + begin, row_bytes)
+
+    def num_rows(self, name):
+        return self.tensors[name][1][0]
+
+    def rows(self, name, start, stop):
+        """
+        Zero-copy view of rows [start, stop) of tensor `name`.
+        """
+        dtype, shape, offset, row_bytes = self.tensors[name]
+        assert 0 <= start < stop <= shape[0], f"rows [{start}, {stop}) out of range for {name} in {self.path}"
+        count = (stop - start) * math.prod(shape[1:])
+        rows = torch.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset + start * row_bytes)
+        return rows.view(stop - start, *shape[1:])
+
+    def close(self):
+        # row views keep a reference to the mapping, so it is unmapped (and its descriptor closed)
+        # once the last view is freed instead of invalidating views that are still in flight
+        self._mmap = None
+
+
+class ShardCache:
+    """
+    Per-process LRU cache of MmapShard handles, capped at max_open_files.
+    DataLoader workers get their own handles: the cache is dropped when it is used from a new process.
+    """
+    def __init__(self, max_open_files=64):
+        self.max_open_files = max_open_files
+        self._shards = OrderedDict()
+        self._pid = os.getpid()
+
+    def get(self, path):
+        if self._pid != os.getpid():
+            # forked into a worker, do not share (or close) the parent's handles
+            self._shards = OrderedDict()
+            self._pid = os.getpid()
+
+        shard = self._shards.get(path)
+        if shard is not None:
+            self._shards.move_to_end(path)
+            return shard
+
+        shard = MmapShard(path)
+        self._shards[path] = shard
+        while len(self._shards) > self.max_open_files:
+            _, evicted = self._shards.popitem(last=False)
+            evicted.close()
+        return shard
+
+    def clear(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = OrderedDict()
+
+    def __getstate__(self):
+        # handles are never pickled (e.g. spawn-based workers), they are reopened lazily
+        return {'max_open_files': self.max_open_files}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_open_files'])
@@ -0,0 +1,85 @@
+"""
+Shard-aware block shuffling for ImgLatentDataset.
+"""
+
+import math
+import numpy as np
+
+from torch.utils.data import Sampler
+
+
+class ShardBlockSampler(Sampler):
+    """
+    Shuffle contiguous row blocks instead of single rows, so that consecutive indices
+    are sequential reads from the same shard.
+
+    Every epoch the shard order is shuffled, shards are taken in groups of `shards_per_group`,
+    and the blocks of all shards in a group are shuffled together.
+    `block_size` and `shards_per_group` set the randomness level: 1 and len(shards) is a full shuffle.
+    Blocks are dealt round-robin over ranks, the order only depends on (seed, epoch).
+    """
+    def __init__(self, file_offsets, block_size=64, shards_per_group=1, num_replicas=1, rank=0, seed=0, drop_last=True):
+        self.file_offsets = np.asarray(file_offsets, dtype=np.int64)
+        self.block_size = block_size
+        self.shards_per_group = shards_per_group
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_index = 0
+
+        total_size = int(self.file_offsets[-1])
+        if drop_last:
+            self.num_samples = total_size // num_replicas
+        else:
+            self.num_samples = math.ceil(total_size / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        """
+        Skip the first `start_index` samples of this rank in the current epoch (resume mid-epoch).
+        Skipped indices are never yielded, so the DataLoader does not read them.
+        """
+        self.start_index = start_index
+
+    def get_blocks(self):
+        """
+        Start and stop rows of all blocks in the order of this epoch.
+        """
+        rng = np.random.default_rng([self.seed, self.epoch])
+        num_files = len(self.file_offsets) - 1
+        shard_order = rng.permutation(num_files)
+
+        starts = []
+        for group_start in range(0, num_files, self.shards_per_group):
+            group_starts = np.concatenate([
+                np.arange(self.file_offsets[file_idx], self.file_offsets[file_idx + 1], self.block_size)
+                for file_idx in shard_order[group_start:group_start + self.shards_per_group]
+            ])
+            starts.append(group_starts[rng.permutation(len(group_starts))])
+        starts = np.concatenate(starts + [np.zeros(0, dtype=np.int64)])
+        # a block ends at the block size or at the end of its shard
+        file_ends = self.file_offsets[np.searchsorted(self.file_offsets, starts, side='right')]
+        stops = np.minimum(starts + self.block_size, file_ends)
+        return starts, stops
+
+    def __iter__(self):
+        starts, stops = self.get_blocks()
+        starts, stops = starts[self.rank::self.num_replicas], stops[self.rank::self.num_replicas]
+        lengths = stops - starts
+        # expand blocks to row indices without a python loop over blocks
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        indices = offsets + np.arange(int(lengths.sum()), dtype=np.int64)
+
+        if len(indices) < self.num_samples:
+            # pad by wrapping around, like DistributedSampler
+            indices = np.resize(indices, self.num_samples)
+        indices = indices[self.start_index:self.num_samples]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start_index
@@ -0,0 +1,140 @@
+"""
+Background safetensors shard writer with a resumable per-rank manifest for feature extraction.
+"""
+
+import os
+import json
+import queue
+import hashlib
+import threading
+
+from safetensors.torch import save_file
+
+
+def manifest_path(output_dir, rank):
+    return os.path.join(output_dir, f'manifest_rank{rank:02d}.json')
+
+
+def file_checksum(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def atomic_write_json(obj, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(output_dir, rank, world_size, batch_size, verify_checksums='last'):
+    """
+    Load the manifest of one rank and drop shards that are missing, incomplete or corrupted on disk.
+    The manifest is only valid for the same world size and batch size, otherwise extraction restarts.
+    verify_checksums: 'last' re-hashes the last kept shard (the one a crash could have hit),
+        'all' every kept shard, 'none' trusts size plus the atomic rename.
+    Returns:
+        manifest dict with 'world_size', 'batch_size' and 'shards' (file, start, stop, size, checksum)
+    """
+    path = manifest_path(output_dir, rank)
+    manifest = {'world_size': world_size, 'batch_size': batch_size, 'shards': []}
+    if not os.path.exists(path):
+        return manifest
+    with open(path, 'r') as f:
+        saved = json.load(f)
+    if saved['world_size'] != world_size or saved['batch_size'] != batch_size:
+        print(f'Manifest {path} was written with world_size={saved["world_size"]}, batch_size={saved["batch_size"]}, ignoring it.')
+        return manifest
+
+    # keep the longest prefix of complete shards, ranges have to stay contiguous
+    for shard in saved['shards']:
+        shard_file = os.path.join(output_dir, shard['file'])
+        if not os.path.exists(shard_file) or os.path.getsize(shard_file) != shard['size']:
+            break
+        manifest['shards'].append(shard)
+
+    # a shard with a wrong checksum and everything after it is extracted again
+    shards = manifest['shards']
+    to_verify = range(len(shards)) if verify_checksums == 'all' else [len(shards) - 1] if verify_checksums == 'last' and shards else []
+    for i in to_verify:
+        if file_checksum(os.path.join(output_dir, shards[i]['file'])) != shards[i]['checksum']:
+            print(f'Checksum mismatch of {shards[i]["file"]}, extracting again from sample {shards[i]["start"]}.')
+            manifest['shards'] = shards[:i]
+            break
+    return manifest
+
+
+def load_manifest_files(output_dir, world_size):
+    """
+    Shard files of all ranks listed in their manifests.
+    """
+    files = []
+    for rank in range(world_size):
+        with open(manifest_path(output_dir, rank), 'r') as f:
+            files.extend(os.path.join(output_dir, shard['file']) for shard in json.load(f)['shards'])
+    return sorted(files)
+
+
+class ShardWriter:
+    """
+    Serialize shards in a background thread so that encoding continues while a shard is written.
+    At most `max_pending` shards wait in the queue, put() blocks beyond that to bound host memory.
+    A shard is added to the manifest only after it was written completely and renamed into place.
+    """
+    def __init__(self, output_dir, manifest, rank, max_pending=2, verbose=False):
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.rank = rank
+        self.verbose = verbose
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, save_dict, filename, metadata, start, stop):
+        """
+        Queue a shard holding local sample indices [start, stop) of this rank.
+        """
+        self._raise_error()
+        self._queue.put((save_dict, filename, metadata, start, stop))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Background shard writer failed') from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, save_dict, filename, metadata, start, stop):
+        save_filename = os.path.join(self.output_dir, filename)
+        tmp_filename = f'{save_filename}.tmp'
+        save_file(save_dict, tmp_filename, metadata=metadata)
+        os.replace(tmp_filename, save_filename)
+
+        self.manifest['shards'].append({
+            'file': filename,
+            'start': start,
+            'stop': stop,
+            'size': os.path.getsize(save_filename),
+            'checksum': file_checksum(save_filename),
+        })
+        atomic_write_json(self.manifest, manifest_path(self.output_dir, self.rank))
+        if self.verbose:
+            print(f'Saved {save_filename}')
@@ -24,6 +24,7 @@ from tools.calculate_fid import calculate_fid_given_paths
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from torchmetrics import StructuralSimilarityIndexMeasure
 from models.lpips import LPIPS
+from tokenizer.preprocessing import DraftLoader
 from torchvision.datasets import ImageFolder
 from torchvision import transforms
 from diffusers.models import AutoencoderKL
@@ -63,7 +64,8 @@ def evaluate_tokenizer(config_path, model_type, data_path, output_path):
     ])
 
     # Create dataset and dataloader
-    dataset = ImageFolder(root=data_path, transform=transform)
+    # JPEGs are decoded at reduced resolution (>= 2x the target size), see tokenizer/preprocessing.py
+    dataset = ImageFolder(root=data_path, transform=transform, loader=DraftLoader(256))
     distributed_sampler = DistributedSampler(dataset, num_replicas=dist.get_world_size(), rank=local_rank)
     val_dataloader = DataLoader(
         dataset,
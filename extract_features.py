@@ -2,14 +2,15 @@ import torch
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 import torch.distributed as dist
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from torch.utils.data.distributed import DistributedSampler
 from torchvision.datasets import ImageFolder
 import argparse
 import os
-from safetensors.torch import save_file
 from datetime import datetime
 from datasets.img_latent_dataset import ImgLatentDataset
+from datasets.latent_stats import LatentStats
+from datasets.shard_writer import ShardWriter, load_manifest, load_manifest_files
 from tokenizer.vavae import VA_VAE
 
 def main(args):
@@ -47,111 +48,100 @@ def main(args):
     )
 
     # Setup data:
-    datasets = [
-        ImageFolder(args.data_path, transform=tokenizer.img_transform(p_hflip=0.0)),
-        ImageFolder(args.data_path, transform=tokenizer.img_transform(p_hflip=1.0))
-    ]
-    samplers = [
-        DistributedSampler(
-            dataset,
-            num_replicas=world_size,
-            rank=rank,
-            shuffle=False,
-            seed=args.seed
-        ) for dataset in datasets
-    ]
-    loaders = [
-        DataLoader(
-            dataset,
-            batch_size=args.batch_size,
-            shuffle=False,
-            sampler=sampler,
-            num_workers=args.num_workers,
-            pin_memory=True,
-            drop_last=False
-        ) for dataset, sampler in zip(datasets, samplers)
-    ]
-    total_data_in_loop = len(loaders[0].dataset)
+    # every image is decoded once, the flipped view is made from the tensor (torch.flip of the normalized
+    # image equals RandomHorizontalFlip(p=1.0) before ToTensor/Normalize)
+    dataset = ImageFolder(args.data_path, transform=tokenizer.img_transform(p_hflip=0.0), loader=tokenizer.img_loader())
+    sampler = DistributedSampler(
+        dataset,
+        num_replicas=world_size,
+        rank=rank,
+        shuffle=False,
+        seed=args.seed
+    )
+    total_data_in_loop = len(dataset)
     if rank == 0:
         print(f"Total data in one loop: {total_data_in_loop}")
 
-    run_images = 0
-    saved_files = 0
+    # Resume from the manifest: skip the local sample range covered by completed shards
+    manifest = load_manifest(output_dir, rank, world_size, args.batch_size, verify_checksums=args.verify_checksums)
+    local_indices = list(sampler)
+    done_images = manifest['shards'][-1]['stop'] if len(manifest['shards']) > 0 else 0
+    if done_images > 0:
+        print(f'Rank {rank} resumes from manifest: {len(manifest["shards"])} shards, {done_images} images done')
+    loader = DataLoader(
+        Subset(dataset, local_indices[done_images:]),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=True,
+        drop_last=False
+    )
+    writer = ShardWriter(output_dir, manifest, rank, max_pending=args.writer_queue_size, verbose=rank == 0)
+
+    run_images = done_images
+    saved_files = len(manifest['shards'])
+    shard_start = done_images
     latents = []
     latents_flip = []
     labels = []
-    for batch_idx, batch_data in enumerate(zip(*loaders)):
-        run_images += batch_data[0][0].shape[0]
+    # per-shard latent stats, stored in the shard metadata so ImgLatentDataset needs no second pass
+    shard_stats = LatentStats()
+
+    def save_shard():
+        save_dict = {
+            'latents': torch.cat(latents, dim=0),
+            'latents_flip': torch.cat(latents_flip, dim=0),
+            'labels': torch.cat(labels, dim=0)
+        }
+        for key in save_dict:
+            if rank == 0:
+                print(key, save_dict[key].shape)
+        num_images = save_dict['latents'].shape[0]
+        metadata = {
+            'total_size': f'{num_images}',
+            'dtype': f'{save_dict["latents"].dtype}',
+            'device': f'{save_dict["latents"].device}',
+            'latent_stats': shard_stats.to_metadata(),
+        }
+        # serialized in the background, blocks only if the writer queue is full
+        writer.put(save_dict, f'latents_rank{rank:02d}_shard{saved_files:03d}.safetensors', metadata, shard_start, shard_start + num_images)
+        return num_images
+
+    for batch_idx, (x, y) in enumerate(loader):
+        run_images += x.shape[0]
         if run_images % 100 == 0 and rank == 0:
             print(f'{datetime.now()} processing {run_images} of {total_data_in_loop} images')
-        
-        for loader_idx, data in enumerate(batch_data):
-            x = data[0]
-            y = data[1]  # (N,)
-            
-            z = tokenizer.encode_images(x).detach().cpu()  # (N, C, H, W)
-
-            if batch_idx == 0 and rank == 0:
-                print('latent shape', z.shape, 'dtype', z.dtype)
-            
-            if loader_idx == 0:
-                latents.append(z)
-                labels.append(y)
-            else:
-                latents_flip.append(z)
+
+        # encode original and flipped images in one batch
+        x = x.cuda(non_blocking=True)
+        x = torch.cat([x, torch.flip(x, dims=[3])], dim=0)
+        z, z_flip = tokenizer.encode_images(x).detach().cpu().chunk(2, dim=0)  # (N, C, H, W) each
+
+        if batch_idx == 0 and rank == 0:
+            print('latent shape', z.shape, 'dtype', z.dtype)
+
+        latents.append(z)
+        latents_flip.append(z_flip)
+        labels.append(y)  # (N,)
+        shard_stats.update(z)
 
         if len(latents) == 10000 // args.batch_size:
-            latents = torch.cat(latents, dim=0)
-            latents_flip = torch.cat(latents_flip, dim=0)
-            labels = torch.cat(labels, dim=0)
-            save_dict = {
-                'latents': latents,
-                'latents_flip': latents_flip,
-                'labels': labels
-            }
-            for key in save_dict:
-                if rank == 0:
-                    print(key, save_dict[key].shape)
-            save_filename = os.path.join(output_dir, f'latents_rank{rank:02d}_shard{saved_files:03d}.safetensors')
-            save_file(
-                save_dict,
-                save_filename,
-                metadata={'total_size': f'{latents.shape[0]}', 'dtype': f'{latents.dtype}', 'device': f'{latents.device}'}
-            )
-            if rank == 0:
-                print(f'Saved {save_filename}')
-            
+            shard_start += save_shard()
             latents = []
             latents_flip = []
             labels = []
+            shard_stats = LatentStats()
             saved_files += 1
 
     # save remainder latents that are fewer than 10000 images
     if len(latents) > 0:
-        latents = torch.cat(latents, dim=0)
-        latents_flip = torch.cat(latents_flip, dim=0)
-        labels = torch.cat(labels, dim=0)
-        save_dict = {
-            'latents': latents,
-            'latents_flip': latents_flip,
-            'labels': labels
-        }
-        for key in save_dict:
-            if rank == 0:
-                print(key, save_dict[key].shape)
-        save_filename = os.path.join(output_dir, f'latents_rank{rank:02d}_shard{saved_files:03d}.safetensors')
-        save_file(
-            save_dict,
-            save_filename,
-            metadata={'total_size': f'{latents.shape[0]}', 'dtype': f'{latents.dtype}', 'device': f'{latents.device}'}
-        )
-        if rank == 0:
-            print(f'Saved {save_filename}')
+        save_shard()
+    writer.close()
 
-    # Calculate latents stats
+    # Calculate latents stats and index over the shards listed in the manifests
     dist.barrier()
     if rank == 0:
-        dataset = ImgLatentDataset(output_dir, latent_norm=True)
+        dataset = ImgLatentDataset(output_dir, latent_norm=True, files=load_manifest_files(output_dir, world_size))
     dist.barrier()
     dist.destroy_process_group()
 
@@ -166,5 +156,8 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=20)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--writer_queue_size", type=int, default=2, help="max shards waiting for the background writer")
+    parser.add_argument("--verify_checksums", type=str, default='last', choices=['last', 'all', 'none'],
+                        help="shards of the manifest whose checksum is verified on resume")
     args = parser.parse_args()
     main(args)
\ No newline at end of file
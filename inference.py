@@ -22,7 +22,9 @@ from tokenizer.vavae import VA_VAE
 # from models.lightningdit import LightningDiT_models
 from models.flashdit import FlashDiT_models
 from transport import create_transport, Sampler
+from transport.solvers import nfe_summary, NATIVE_SOLVERS
 from datasets.img_latent_dataset import ImgLatentDataset
+from training.checkpoint import load_model_weights
 
 # sample function
 def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=None, vae=None, demo_sample_mode=False):
@@ -30,7 +32,7 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
     Run sampling.
     """
 
-    folder_name = f"{train_config['model']['model_type'].replace('/', '-')}-ckpt-{ckpt_path.split('/')[-1].split('.')[0]}-{train_config['sample']['sampling_method']}-{train_config['sample']['num_sampling_steps']}".lower()
+    folder_name = f"{train_config['model']['model_type'].replace('/', '-')}-ckpt-{ckpt_path.rstrip('/').split('/')[-1].split('.')[0]}-{train_config['sample']['sampling_method']}-{train_config['sample']['num_sampling_steps']}".lower()
     if cfg_scale is None:
         cfg_scale = train_config['sample']['cfg_scale']
     cfg_interval_start = train_config['sample']['cfg_interval_start'] if 'cfg_interval_start' in train_config['sample'] else 0
@@ -38,6 +40,22 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
     if cfg_scale > 1.0:
         folder_name += f"-interval{cfg_interval_start:.2f}"+f"-cfg{cfg_scale:.2f}"
         folder_name += f"-shift{timestep_shift:.2f}"
+    # cross-step block feature cache, see FlashDiT.enable_block_cache
+    block_cache_interval = train_config['sample']['block_cache_interval'] if 'block_cache_interval' in train_config['sample'] else 0
+    block_cache_start = train_config['sample']['block_cache_start'] if 'block_cache_start' in train_config['sample'] else 4
+    block_cache_end = train_config['sample']['block_cache_end'] if 'block_cache_end' in train_config['sample'] else model.depth - 4
+    # the uncached run with otherwise identical settings, which report_sampling compares against
+    uncached_folder_name = folder_name
+    if block_cache_interval > 0:
+        assert train_config['sample']['sampling_method'] in NATIVE_SOLVERS, \
+            "the block cache counts solver steps, which only the native solvers report"
+        folder_name += f"-cache{block_cache_start}-{block_cache_end}-every{block_cache_interval + 1}steps"
+    # step size control per sample with refill of finished samples, see transport/solvers.py adaptive_ode
+    per_sample_adaptive = train_config['sample']['per_sample_adaptive'] if 'per_sample_adaptive' in train_config['sample'] else False
+    if per_sample_adaptive:
+        assert block_cache_interval == 0, "the block cache needs a fixed batch and time grid, disable it for per-sample adaptive sampling"
+        folder_name += f"-persample-atol{train_config['sample']['atol']}-rtol{train_config['sample']['rtol']}"
+        uncached_folder_name = folder_name
 
     if demo_sample_mode:
         cfg_interval_start = 0
@@ -52,6 +70,8 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
         print_with_prefix('cfg_scale=', cfg_scale)
         print_with_prefix('cfg_interval_start=', cfg_interval_start)
         print_with_prefix('timestep_shift=', timestep_shift)
+        if block_cache_interval > 0:
+            print_with_prefix(f'block_cache: blocks [{block_cache_start}, {block_cache_end}) reused for {block_cache_interval} steps')
 
     if not os.path.exists(sample_folder_dir):
         if accelerator.process_index == 0:
@@ -86,12 +106,15 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
         downsample_ratio = 16
     latent_size = train_config['data']['image_size'] // downsample_ratio
 
-    checkpoint = torch.load(ckpt_path, map_location=lambda storage, loc: storage)
-    if "ema" in checkpoint:  # supports checkpoints from train.py
-        checkpoint = checkpoint["ema"]
+    # checkpoint directories from train.py hold ema.safetensors, which is memory-mapped without the optimizer state
+    checkpoint = load_model_weights(ckpt_path, 'ema')
     model.load_state_dict(checkpoint)
     model.eval()  # important!
     model.to(device)
+    if block_cache_interval > 0:
+        model.enable_block_cache(block_cache_start, block_cache_end, block_cache_interval)
+    else:
+        model.disable_block_cache()
 
     transport = create_transport(
         train_config['transport']['path_type'],
@@ -104,7 +127,16 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
     )  # default: velocity;
     sampler = Sampler(transport)
     mode = train_config['sample']['mode']
-    if mode == "ODE":
+    if mode == "ODE" and per_sample_adaptive:
+        ode_solver = sampler.sample_ode_adaptive(
+            sampling_method=train_config['sample']['sampling_method'],
+            num_steps=train_config['sample']['num_sampling_steps'],
+            atol=train_config['sample']['atol'],
+            rtol=train_config['sample']['rtol'],
+            reverse=train_config['sample']['reverse'],
+        )
+        sample_fn = ode_solver.sample
+    elif mode == "ODE":
         sample_fn = sampler.sample_ode(
             sampling_method=train_config['sample']['sampling_method'],
             num_steps=train_config['sample']['num_sampling_steps'],
@@ -128,6 +160,14 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
         if accelerator.process_index == 0:
             print_with_prefix('Using cfg:', using_cfg)
 
+    def guided_model_fn(x, t, y, cfg_interval=True):
+        # the per-sample solver compacts the batch, so it keeps only the conditional half and the
+        # null-class half is built here for every evaluation
+        y_null = torch.full_like(y, 1000)
+        model_out = model.forward_with_cfg(torch.cat([x, x], 0), torch.cat([t, t], 0), torch.cat([y, y_null], 0),
+                                           cfg_scale, cfg_interval=cfg_interval, cfg_interval_start=cfg_interval_start)
+        return model_out[: len(x)]
+
     if rank == 0:
         os.makedirs(sample_folder_dir, exist_ok=True)
         if accelerator.process_index == 0 and not demo_sample_mode:
@@ -173,12 +213,18 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
             for label in tqdm([975, 3, 207, 387, 388, 88, 979, 279], desc="Generating Demo Samples"):
                 z = torch.randn(1, model.in_channels, latent_size, latent_size, device=device)
                 y = torch.tensor([label], device=device)
-                z = torch.cat([z, z], 0)
-                y_null = torch.tensor([1000] * 1, device=device)
-                y = torch.cat([y, y_null], 0)
-                model_kwargs = dict(y=y, cfg_scale=cfg_scale, cfg_interval=False, cfg_interval_start=cfg_interval_start)
-                model_fn = model.forward_with_cfg
-                samples = sample_fn(z, model_fn, **model_kwargs)[-1]
+                if per_sample_adaptive:
+                    samples = sample_fn(z, guided_model_fn, y=y, cfg_interval=False)[-1]
+                else:
+                    z = torch.cat([z, z], 0)
+                    y_null = torch.tensor([1000] * 1, device=device)
+                    y = torch.cat([y, y_null], 0)
+                    model_kwargs = dict(y=y, cfg_scale=cfg_scale, cfg_interval=False, cfg_interval_start=cfg_interval_start)
+                    model_fn = model.forward_with_cfg
+                    model.reset_block_cache()
+                    if block_cache_interval > 0:
+                        model_kwargs['callback'] = model.advance_block_cache
+                    samples = sample_fn(z, model_fn, **model_kwargs)[-1]
                 samples = (samples * latent_std) / latent_multiplier + latent_mean
                 samples = vae.decode_to_images(samples)
                 images.append(samples)
@@ -197,7 +243,43 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
             Image.fromarray(grid).save('demo_images/demo_samples.png')
 
             return None
+    elif per_sample_adaptive:
+        sampling_time = 0.0
+        def init_fn(start, count):
+            z = torch.randn(count, model.in_channels, latent_size, latent_size, device=device)
+            y = torch.randint(0, train_config['data']['num_classes'], (count,), device=device)
+            return z, dict(y=y)
+        stream = ode_solver.stream(init_fn, samples_needed_this_gpu, n, guided_model_fn if using_cfg else model.forward)
+        pbar = tqdm(total=samples_needed_this_gpu) if rank == 0 and not demo_sample_mode else None
+        nfe_all, pending_ids, pending_samples = [], [], []
+        while True:
+            torch.cuda.synchronize()
+            start_time = time()
+            finished = next(stream, None)
+            torch.cuda.synchronize()
+            sampling_time += time() - start_time
+            if finished is not None:
+                ids, samples, nfe = finished
+                pending_ids.append(ids)
+                pending_samples.append(samples)
+                nfe_all.append(nfe)
+            # decode in batches of per_proc_batch_size, samples finish a few at a time
+            num_pending = sum(len(ids) for ids in pending_ids)
+            if num_pending >= n or (finished is None and num_pending > 0):
+                ids, samples = torch.cat(pending_ids), torch.cat(pending_samples)
+                pending_ids, pending_samples = [], []
+                samples = (samples * latent_std) / latent_multiplier + latent_mean
+                samples = vae.decode_to_images(samples)
+                for sample_id, sample in zip(ids.tolist(), samples):
+                    index = sample_id * accelerator.num_processes + accelerator.process_index
+                    Image.fromarray(sample).save(f"{sample_folder_dir}/{index:06d}.png")
+                if pbar is not None:
+                    pbar.update(len(ids))
+            if finished is None:
+                break
+        accelerator.wait_for_everyone()
     else:
+        sampling_time = 0.0
         for i in pbar:
             # Sample inputs:
             z = torch.randn(n, model.in_channels, latent_size, latent_size, device=device)
@@ -214,7 +296,14 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
                 model_kwargs = dict(y=y)
                 model_fn = model.forward
 
+            model.reset_block_cache()
+            if block_cache_interval > 0:
+                model_kwargs['callback'] = model.advance_block_cache
+            torch.cuda.synchronize()
+            start_time = time()
             samples = sample_fn(z, model_fn, **model_kwargs)[-1]
+            torch.cuda.synchronize()
+            sampling_time += time() - start_time
             if using_cfg:
                 samples, _ = samples.chunk(2, dim=0)  # Remove null class samples
 
@@ -228,14 +317,91 @@ def do_sample(train_config, accelerator, ckpt_path=None, cfg_scale=None, model=N
             total += global_batch_size
             accelerator.wait_for_everyone()
 
+    if not demo_sample_mode:
+        if accelerator.process_index == 0:
+            sampling_stats = {
+                'sampling_seconds': sampling_time,
+                'images_per_proc': iterations * n,
+                'block_cache_interval': block_cache_interval,
+                'block_cache_start': block_cache_start,
+                'block_cache_end': block_cache_end,
+                'folder_name': folder_name,
+                'uncached_folder_name': uncached_folder_name,
+            }
+            if per_sample_adaptive:
+                sampling_stats.update(nfe_summary(torch.cat(nfe_all)))
+                print_with_prefix("Per-sample NFE: " + ", ".join(f"{k[4:]} {v:.1f}" for k, v in sampling_stats.items() if k.startswith('nfe_')))
+            with open(os.path.join(sample_folder_dir, 'sampling_stats.json'), 'w') as f:
+                json.dump(sampling_stats, f, indent=4)
+            print_with_prefix(f"Sampling time (rank 0, without VAE decoding): {sampling_time:.1f}s")
+
     return sample_folder_dir
 
+def report_sampling(train_config, sample_folder_dir, fid):
+    """
+    Append sampling wall-clock time and FID to the experiment report and
+    compare against the run without block cache (same checkpoint and sampling settings).
+    Stats that were already reported (do_sample skipped sampling for an existing folder) are not appended again.
+    """
+    stats_file = os.path.join(sample_folder_dir, 'sampling_stats.json')
+    if not os.path.exists(stats_file):
+        return
+    with open(stats_file, 'r') as f:
+        record = json.load(f)
+    if record.get('reported', False):
+        return
+    record['sample_folder_dir'] = sample_folder_dir
+    record['fid'] = float(fid)
+
+    report_file = os.path.join(train_config['train']['output_dir'], train_config['train']['exp_name'], 'sampling_report.jsonl')
+    with open(report_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    with open(stats_file, 'w') as f:
+        json.dump(dict(record, reported=True), f, indent=4)
+
+    if record['block_cache_interval'] == 0:
+        return
+    with open(report_file, 'r') as f:
+        baselines = [r for r in map(json.loads, f)
+                     if r.get('folder_name') == record['uncached_folder_name'] and r['block_cache_interval'] == 0]
+    if len(baselines) == 0:
+        print_with_prefix(f'No baseline run without block cache found in {report_file}')
+        return
+    baseline = baselines[-1]
+    saving = 1 - record['sampling_seconds'] / baseline['sampling_seconds']
+    print_with_prefix(f"Block cache: wall-clock {record['sampling_seconds']:.1f}s vs {baseline['sampling_seconds']:.1f}s "
+                      f"({saving * 100:.1f}% saved), FID {record['fid']:.3f} vs {baseline['fid']:.3f} "
+                      f"(drift {record['fid'] - baseline['fid']:+.3f})")
+
 # some utils
 def print_with_prefix(*messages):
     prefix = f"\033[34m[LightningDiT-Sampling {strftime('%Y-%m-%d %H:%M:%S')}]\033[0m"
     combined_message = ' '.join(map(str, messages))
     print(f"{prefix}: {combined_message}")
 
+def build_model(train_config):
+    """
+    FlashDiT of the config, without weights.
+    """
+    if 'downsample_ratio' in train_config['vae']:
+        latent_size = train_config['data']['image_size'] // train_config['vae']['downsample_ratio']
+    else:
+        latent_size = train_config['data']['image_size'] // 16
+
+    # get model
+    model = FlashDiT_models[train_config['model']['model_type']](
+        input_size=latent_size,
+        num_classes=train_config['data']['num_classes'],
+        use_qknorm=train_config['model']['use_qknorm'],
+        use_swiglu=train_config['model']['use_swiglu'] if 'use_swiglu' in train_config['model'] else False,
+        use_rope=train_config['model']['use_rope'] if 'use_rope' in train_config['model'] else False,
+        use_rmsnorm=train_config['model']['use_rmsnorm'] if 'use_rmsnorm' in train_config['model'] else False,
+        wo_shift=train_config['model']['wo_shift'] if 'wo_shift' in train_config['model'] else False,
+        in_channels=train_config['model']['in_chans'] if 'in_chans' in train_config['model'] else 4,
+        learn_sigma=train_config['model']['learn_sigma'] if 'learn_sigma' in train_config['model'] else False,
+    )
+    return model
+
 def load_config(config_path):
     with open(config_path, "r") as file:
         config = yaml.safe_load(file)
@@ -309,23 +475,7 @@ if __name__ == "__main__":
         print_with_prefix('Using ckpt:', train_config['ckpt_path'])
     ckpt_dir = train_config['ckpt_path']
 
-    if 'downsample_ratio' in train_config['vae']:
-        latent_size = train_config['data']['image_size'] // train_config['vae']['downsample_ratio']
-    else:
-        latent_size = train_config['data']['image_size'] // 16
-
-    # get model
-    model = FlashDiT_models[train_config['model']['model_type']](
-        input_size=latent_size,
-        num_classes=train_config['data']['num_classes'],
-        use_qknorm=train_config['model']['use_qknorm'],
-        use_swiglu=train_config['model']['use_swiglu'] if 'use_swiglu' in train_config['model'] else False,
-        use_rope=train_config['model']['use_rope'] if 'use_rope' in train_config['model'] else False,
-        use_rmsnorm=train_config['model']['use_rmsnorm'] if 'use_rmsnorm' in train_config['model'] else False,
-        wo_shift=train_config['model']['wo_shift'] if 'wo_shift' in train_config['model'] else False,
-        in_channels=train_config['model']['in_chans'] if 'in_chans' in train_config['model'] else 4,
-        learn_sigma=train_config['model']['learn_sigma'] if 'learn_sigma' in train_config['model'] else False,
-    )
+    model = build_model(train_config)
 
         # Print Conv2D weights if requested
     # if accelerator.process_index == 0:
@@ -354,3 +504,4 @@ if __name__ == "__main__":
                 sp_len = train_config['sample']['fid_num']
             )
             print_with_prefix('fid=',fid)
+            report_sampling(train_config, sample_folder_dir, fid)
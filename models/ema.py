@@ -0,0 +1,70 @@
+"""
+Multi-tensor EMA of model parameters.
+"""
+
+import torch
+
+
+class ForeachEMA:
+    """
+    Exponential moving average of a model's parameters updated with torch._foreach kernels.
+    Parameter lists are bound once at construction, an update is a couple of multi-tensor launches
+    instead of two kernels per parameter.
+
+    Args:
+        ema_model: model holding the EMA weights, may live on CPU (offloaded EMA)
+        model: trained model (unwrapped, i.e. without the DDP `module.` prefix)
+        decay: EMA decay per training step
+        update_every: update every k steps with decay ** k, which keeps the same averaging horizon
+    """
+    def __init__(self, ema_model, model, decay=0.9999, update_every=1):
+        ema_params = dict(ema_model.named_parameters())
+        # frozen parameters (e.g. a fixed pos_embed) stay as they are in the EMA copy
+        names = [name for name, param in model.named_parameters() if param.requires_grad]
+        model_params = dict(model.named_parameters())
+        self._bind(
+            [ema_params[name.replace("module.", "")] for name in names],
+            [model_params[name] for name in names],
+            decay,
+            update_every,
+        )
+
+    @classmethod
+    def from_params(cls, ema_params, model_params, decay=0.9999, update_every=1):
+        """
+        EMA over already paired lists of EMA tensors and model parameters, e.g. the shadow buffers of LitEma.
+        """
+        ema = cls.__new__(cls)
+        ema._bind(list(ema_params), list(model_params), decay, update_every)
+        return ema
+
+    def _bind(self, ema_params, model_params, decay, update_every):
+        assert len(ema_params) == len(model_params)
+        self.decay = decay
+        self.update_every = update_every
+        self.num_steps = 0
+        self.ema_params = ema_params
+        self.model_params = model_params
+        # offloaded or lower precision EMA copies need the model parameters converted first
+        self.convert = any(e.device != p.device or e.dtype != p.dtype for e, p in zip(ema_params, model_params))
+
+    @torch.no_grad()
+    def update(self, decay=None):
+        """
+        Step the EMA weights towards the current model weights.
+        """
+        decay = self.decay if decay is None else decay
+        if self.convert:
+            params = [p.detach().to(e.device, dtype=e.dtype) for e, p in zip(self.ema_params, self.model_params)]
+        else:
+            params = [p.detach() for p in self.model_params]
+        torch._foreach_mul_(self.ema_params, decay)
+        torch._foreach_add_(self.ema_params, params, alpha=1 - decay)
+
+    def step(self):
+        """
+        Call once per optimizer step, updates every `update_every` steps with a corrected decay.
+        """
+        self.num_steps += 1
+        if self.num_steps % self.update_every == 0:
+            self.update(self.decay ** self.update_every)
@@ -17,6 +17,8 @@ from models.swiglu_ffn import SwiGLUFFN
 from models.pos_embed import VisionRotaryEmbeddingFast
 from models.rmsnorm import RMSNorm
 
+CHECKPOINT_MODES = ('none', 'attn', 'mlp', 'full')
+
 @torch.compile
 def modulate(x, shift, scale):
     if shift is None:
@@ -55,6 +57,26 @@ def window_reverse(windows, window_size: tuple, H: int, W: int):
     return x
 
 
+def build_token_plan(H: int, W: int, window_size: tuple, device=None):
+    """
+    Precompute the token permutation of the interleaved window shuffle.
+    Args:
+        H (int): Height of the token grid
+        W (int): Width of the token grid
+        window_size (tuple): Window size
+
+    Returns:
+        perm: (H*W,) index such that x.view(B, H*W, C)[:, perm] equals
+            window_partition(rearrange(x, ...)) flattened to (B, H*W, C)
+        inv_perm: (H*W,) inverse index that undoes window_reverse + restore
+    """
+    idx = torch.arange(H * W, device=device).view(1, H, W, 1)
+    idx = rearrange(idx, H // window_size[0], W // window_size[1])
+    perm = window_partition(idx, window_size).reshape(-1)
+    inv_perm = torch.argsort(perm)
+    return perm, inv_perm
+
+
 def rearrange(x, Hgroup, Wgroup):
     B, H, W, C = x.shape
 
@@ -307,16 +329,17 @@ class FlashDiTBlock(nn.Module):
             )
         self.wo_shift = wo_shift
 
-    @torch.compile
-    def forward(self, x, c, feat_rope=None):
-        if self.wo_shift:
-            scale_msa, gate_msa, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(4, dim=1)
-            shift_msa = None
-            shift_mlp = None
-        else:
-            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-
+        # selective activation checkpointing of the attention / MLP path, set by FlashDiT.set_checkpoint_plan
+        self.checkpoint_attn = False
+        self.checkpoint_mlp = False
 
+    def attn_branch(self, x, shift_msa, scale_msa, token_plan=None, ids_keep=None):
+        """
+        Window attention + depthwise conv path of the block, before gating.
+        With ids_keep, x holds only the visible tokens of whole windows, see FlashDiT.sample_token_mask.
+        """
+        if ids_keep is not None:
+            return self.masked_attn_branch(x, shift_msa, scale_msa, token_plan, ids_keep)
         B, N, C = x.shape
         H = W = int(math.sqrt(N))
 
@@ -327,25 +350,78 @@ class FlashDiTBlock(nn.Module):
         xconv = xm.permute(0, 3, 1, 2).contiguous()
         xconv = self.dwconv(xconv).permute(0, 2, 3, 1)
 
-        xm = rearrange(xm, H // self.window_size[0], W // self.window_size[1])
-
-        # partition windows
-        x_windows = window_partition(xm, self.window_size)  # nW*B, window_size[0], window_size[1], C
-        x_windows = x_windows.view(-1, self.window_size[0] * self.window_size[1], C)  # nW*B, window_size[0]*window_size[1], C
-        # W-MSA
-        attn_windows = self.attn(x_windows, rope=None)  # nW*B, window_size*window_size, C
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size[0], self.window_size[1], C)
-        # reverse window
-        xattn = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
-        # restore x
-        xattn = restore(xattn, H // self.window_size[0], W // self.window_size[1])  # B H W C
+        if token_plan is not None:
+            # interleave + partition as a single gather, see build_token_plan
+            perm, inv_perm = token_plan
+            x_windows = xm.reshape(B, N, C).index_select(1, perm)
+            x_windows = x_windows.view(-1, self.window_size[0] * self.window_size[1], C)  # nW*B, window_size[0]*window_size[1], C
+            # W-MSA
+            attn_windows = self.attn(x_windows, rope=None)  # nW*B, window_size*window_size, C
+            # reverse window + restore x as a single gather with the inverse permutation
+            xattn = attn_windows.view(B, N, C).index_select(1, inv_perm).view(B, H, W, C)  # B H W C
+        else:
+            xm = rearrange(xm, H // self.window_size[0], W // self.window_size[1])
+
+            # partition windows
+            x_windows = window_partition(xm, self.window_size)  # nW*B, window_size[0], window_size[1], C
+            x_windows = x_windows.view(-1, self.window_size[0] * self.window_size[1], C)  # nW*B, window_size[0]*window_size[1], C
+            # W-MSA
+            attn_windows = self.attn(x_windows, rope=None)  # nW*B, window_size*window_size, C
+            # merge windows
+            attn_windows = attn_windows.view(-1, self.window_size[0], self.window_size[1], C)
+            # reverse window
+            xattn = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+            # restore x
+            xattn = restore(xattn, H // self.window_size[0], W // self.window_size[1])  # B H W C
 
         xcom = xconv + xattn
-        xcom = xcom.view(B, N, C)
+        return xcom.view(B, N, C)
 
-        x = x + gate_msa.unsqueeze(1) * x2
-        x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+    def masked_attn_branch(self, x, shift_msa, scale_msa, token_plan, ids_keep):
+        """
+        attn_branch on visible tokens. They are already grouped by window, so attention needs no permutation;
+        the depthwise conv runs on the full grid with masked tokens set to zero.
+        """
+        B, Nv, C = x.shape
+        N = token_plan[0].numel()
+        H = W = int(math.sqrt(N))
+
+        xm = modulate(self.norm1(x), shift_msa, scale_msa)
+
+        # W-MSA on the visible windows
+        xattn = self.attn(xm.reshape(-1, self.window_size[0] * self.window_size[1], C), rope=None).view(B, Nv, C)
+
+        index = ids_keep.unsqueeze(-1).expand(-1, -1, C)
+        xconv = xm.new_zeros(B, N, C).scatter(1, index, xm)
+        xconv = self.dwconv(xconv.view(B, H, W, C).permute(0, 3, 1, 2).contiguous()).permute(0, 2, 3, 1)
+        xconv = xconv.reshape(B, N, C).gather(1, index)
+
+        return xconv + xattn
+
+    def mlp_branch(self, x, shift_mlp, scale_mlp):
+        return self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+
+    @torch.compile
+    def forward(self, x, c, feat_rope=None, token_plan=None, ids_keep=None):
+        if self.wo_shift:
+            scale_msa, gate_msa, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(4, dim=1)
+            shift_msa = None
+            shift_mlp = None
+        else:
+            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
+
+        # non-reentrant checkpoints, traced by torch.compile as part of the block graph
+        if self.checkpoint_attn and torch.is_grad_enabled():
+            xcom = checkpoint(self.attn_branch, x, shift_msa, scale_msa, token_plan, ids_keep, use_reentrant=False)
+        else:
+            xcom = self.attn_branch(x, shift_msa, scale_msa, token_plan, ids_keep)
+        x = x + gate_msa.unsqueeze(1) * xcom
+
+        if self.checkpoint_mlp and torch.is_grad_enabled():
+            xmlp = checkpoint(self.mlp_branch, x, shift_mlp, scale_mlp, use_reentrant=False)
+        else:
+            xmlp = self.mlp_branch(x, shift_mlp, scale_mlp)
+        x = x + gate_mlp.unsqueeze(1) * xmlp
 
         return x
 
@@ -406,7 +482,6 @@ class FlashDiT(nn.Module):
         self.use_rmsnorm = use_rmsnorm
         self.depth = depth
         self.hidden_size = hidden_size
-        self.use_checkpoint = use_checkpoint
         self.x_embedder = PatchEmbed(input_size, patch_size, in_channels, hidden_size, bias=True)
         self.t_embedder = TimestepEmbedder(hidden_size)
         self.y_embedder = LabelEmbedder(num_classes, hidden_size, class_dropout_prob)
@@ -441,6 +516,17 @@ class FlashDiT(nn.Module):
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels, use_rmsnorm=use_rmsnorm)
         self.initialize_weights()
 
+        # token permutation plans of the window shuffle, keyed by (H, W, window_size, device)
+        self.use_token_plan = True
+        self._token_plans = {}
+
+        # activation checkpointing per block, see set_checkpoint_plan
+        self.set_checkpoint_policy('full' if use_checkpoint else 'none')
+
+        # cross-step block feature cache for sampling, see enable_block_cache
+        self.block_cache = None
+        self.reset_block_cache()
+
     def initialize_weights(self):
         # Initialize transformer layers:
         def _basic_init(module):
@@ -478,6 +564,26 @@ class FlashDiT(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
+    def flops_per_sample(self, mask_ratio=0.0):
+        """
+        Estimated forward FLOPs of one sample (a multiply-add counts as 2 FLOPs).
+        Attention only spans the window_size[0] * window_size[1] tokens of each window.
+        With mask_ratio, blocks only process the visible windows (see sample_token_mask).
+        """
+        N = self.x_embedder.num_patches
+        window = self.window_size[0] * self.window_size[1]
+        Nv = N if mask_ratio == 0 else max(1, round((1 - mask_ratio) * (N // window))) * window
+        flops = N * 2 * self.x_embedder.proj.weight.numel()
+        for block in self.blocks:
+            token_linears = [m for m in list(block.attn.modules()) + list(block.mlp.modules()) if isinstance(m, nn.Linear)]
+            flops += Nv * sum(2 * m.weight.numel() for m in token_linears)
+            flops += N * 2 * block.dwconv.depthwise.weight.numel()  # the conv runs on the full grid
+            flops += 2 * 2 * Nv * window * self.hidden_size     # q @ k^T and attn @ v within windows
+            flops += 2 * block.adaLN_modulation[-1].weight.numel()  # once per sample
+        flops += Nv * 2 * self.final_layer.linear.weight.numel()
+        flops += 2 * self.final_layer.adaLN_modulation[-1].weight.numel()
+        return flops
+
     def unpatchify(self, x):
         """
         x: (N, T, patch_size**2 * C)
@@ -493,29 +599,155 @@ class FlashDiT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], c, h * p, h * p))
         return imgs
 
-    def forward(self, x, t=None, y=None):
+    def get_token_plan(self, H, W, device):
+        """
+        Return the cached (perm, inv_perm) of the window shuffle for an H x W token grid.
+        """
+        key = (H, W, self.window_size, str(device))
+        if key not in self._token_plans:
+            self._token_plans[key] = build_token_plan(H, W, self.window_size, device=device)
+        return self._token_plans[key]
+
+    def enable_block_cache(self, start, end, interval):
+        """
+        Reuse the residual of blocks [start, end) across sampling steps (DeepCache-style).
+        Each full step runs all blocks and stores the residual x_end - x_start,
+        the following `interval` partial steps add the stored residual instead of running those blocks.
+        Steps are solver steps, not model evaluations: all evaluations of a step (e.g. the predictor and
+        corrector of heun) are full or partial together. The solver signals the end of a step with
+        advance_block_cache(), e.g. from the callback of the native solvers.
+        Only active in eval mode. Call reset_block_cache() before every new sampling trajectory.
+        """
+        assert 0 <= start < end <= self.depth, f"invalid cached block range [{start}, {end}) for depth {self.depth}"
+        assert interval >= 0, "block cache interval must be non-negative"
+        self.block_cache = dict(start=start, end=end, interval=interval)
+        self.reset_block_cache()
+
+    def disable_block_cache(self):
+        self.block_cache = None
+        self.reset_block_cache()
+
+    def set_checkpoint_plan(self, plan):
+        """
+        Activation checkpointing per block, one of 'none', 'attn', 'mlp' or 'full' for every block.
+        'attn' / 'mlp' recompute only that path of the block, 'full' recomputes the whole block.
+        """
+        assert len(plan) == self.depth, f"checkpoint plan has {len(plan)} entries for {self.depth} blocks"
+        for block, mode in zip(self.blocks, plan):
+            assert mode in CHECKPOINT_MODES, f"unknown checkpoint mode {mode}"
+            block.checkpoint_attn = mode == 'attn'
+            block.checkpoint_mlp = mode == 'mlp'
+        self.checkpoint_plan = list(plan)
+
+    def set_checkpoint_policy(self, policy, every=1):
+        """
+        Apply checkpoint mode `policy` to every `every`-th block, the other blocks are not checkpointed.
+        """
+        self.set_checkpoint_plan([policy if i % every == 0 else 'none' for i in range(self.depth)])
+
+    def sample_token_mask(self, batch_size, mask_ratio, device):
+        """
+        Random masking at whole-window granularity for masked-token training (MaskDiT / MDT style).
+        Every sample keeps round((1 - mask_ratio) * num_windows) random windows of the interleaved partition,
+        so the visible tokens still form complete attention windows.
+
+        Returns:
+            ids_keep: (batch_size, num_visible) token indices, grouped by window
+        """
+        H, W = self.x_embedder.grid_size
+        perm, _ = self.get_token_plan(H, W, device)
+        window_tokens = self.window_size[0] * self.window_size[1]
+        num_windows = H * W // window_tokens
+        num_keep = max(1, round((1 - mask_ratio) * num_windows))
+        windows = torch.rand(batch_size, num_windows, device=device).argsort(dim=1)[:, :num_keep]
+        windows = windows.sort(dim=1).values
+        return perm.view(num_windows, window_tokens)[windows].reshape(batch_size, num_keep * window_tokens)
+
+    def token_mask_to_latent(self, ids_keep):
+        """
+        (B, 1, H, W) latent-resolution mask, 1 on visible tokens, to restrict the loss to them.
+        """
+        H, W = self.x_embedder.grid_size
+        mask = torch.zeros(ids_keep.shape[0], H * W, device=ids_keep.device)
+        mask.scatter_(1, ids_keep, 1.0)
+        mask = mask.view(-1, 1, H, W)
+        return mask.repeat_interleave(self.patch_size, dim=2).repeat_interleave(self.patch_size, dim=3)
+
+    def reset_block_cache(self):
+        self._cached_residual = None
+        self._cache_step = 0
+
+    def advance_block_cache(self, *args):
+        """
+        Move the block cache to the next solver step, takes (and ignores) the solver callback arguments.
+        """
+        self._cache_step += 1
+
+    def forward_blocks(self, x, c, token_plan, start, end, ids_keep=None):
+        """
+        Run blocks [start, end) of FlashDiT.
+        """
+        for block, mode in zip(self.blocks[start:end], self.checkpoint_plan[start:end]):
+            if mode == 'full' and torch.is_grad_enabled():
+                x = checkpoint(block, x, c, self.feat_rope, token_plan, ids_keep, use_reentrant=False)
+            else:
+                x = block(x, c, self.feat_rope, token_plan, ids_keep)
+        return x
+
+    def forward_blocks_cached(self, x, c, token_plan):
+        """
+        Run all blocks of FlashDiT, reusing the cached residual of the block cache range on partial steps.
+        """
+        start, end, interval = self.block_cache['start'], self.block_cache['end'], self.block_cache['interval']
+        # _cache_step counts solver steps (see advance_block_cache), so every evaluation of a full step runs all blocks
+        full_step = (
+            self._cache_step % (interval + 1) == 0
+            or self._cached_residual is None
+            or self._cached_residual.shape != x.shape  # e.g. batch size changed between steps
+        )
+
+        x = self.forward_blocks(x, c, token_plan, 0, start)
+        if full_step:
+            x_start = x
+            x = self.forward_blocks(x, c, token_plan, start, end)
+            self._cached_residual = x - x_start
+        else:
+            x = x + self._cached_residual
+        x = self.forward_blocks(x, c, token_plan, end, self.depth)
+        return x
+
+    def forward(self, x, t=None, y=None, ids_keep=None):
         """
         Forward pass of FlashDiT.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         y: (N,) tensor of class labels
-        use_checkpoint: boolean to toggle checkpointing
+        ids_keep: optional (N, T_visible) visible tokens from sample_token_mask, masked tokens
+            are skipped by all blocks and are zero in the output
         """
 
-        use_checkpoint = self.use_checkpoint
-
         x = self.x_embedder(x)                   # (N, T, D), where T = H * W / patch_size ** 2
         t = self.t_embedder(t)                   # (N, D)
         y = self.y_embedder(y, self.training)    # (N, D)
         c = t + y                                # (N, D)
 
-        for block in self.blocks:
-            if use_checkpoint:
-                x = checkpoint(block, x, c, self.feat_rope, use_reentrant=True)
+        token_plan = None
+        if self.use_token_plan or ids_keep is not None:
+            H, W = self.x_embedder.grid_size
+            token_plan = self.get_token_plan(H, W, x.device)
+
+        if ids_keep is not None:
+            B, T, D = x.shape
+            x = x.gather(1, ids_keep.unsqueeze(-1).expand(-1, -1, D))
+            x = self.forward_blocks(x, c, token_plan, 0, self.depth, ids_keep)
+            x = self.final_layer(x, c)
+            x = x.new_zeros(B, T, x.shape[-1]).scatter(1, ids_keep.unsqueeze(-1).expand(-1, -1, x.shape[-1]), x)
+        else:
+            if self.block_cache is not None and not self.training:
+                x = self.forward_blocks_cached(x, c, token_plan)
             else:
-                x = block(x, c, self.feat_rope)
-
-        x = self.final_layer(x, c)                # (N, T, patch_size ** 2 * out_channels)
+                x = self.forward_blocks(x, c, token_plan, 0, self.depth)
+            x = self.final_layer(x, c)            # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)                   # (N, out_channels, H, W)
 
         if self.learn_sigma:
@@ -528,6 +760,14 @@ class FlashDiT(nn.Module):
         """
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
         half = x[: len(x) // 2]
+        if cfg_interval is True:
+            # t may differ per sample (per-sample adaptive solvers), guidance is applied where t >= cfg_interval_start
+            guided = t[: len(half)] >= cfg_interval_start
+            if not guided.any():
+                # outside the guidance interval the unconditional output is discarded,
+                # so only run the conditional half and return it in the duplicated layout
+                model_out = self.forward(half, t[: len(half)], y[: len(half)])
+                return torch.cat([model_out, model_out], dim=0)
         combined = torch.cat([half, half], dim=0)
         model_out = self.forward(combined, t, y)
         # For exact reproducibility reasons, we apply classifier-free guidance on only
@@ -537,11 +777,8 @@ class FlashDiT(nn.Module):
         eps, rest = model_out[:, :3], model_out[:, 3:]
         cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
         half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
-        
         if cfg_interval is True:
-            timestep = t[0]
-            if timestep < cfg_interval_start:
-                half_eps = cond_eps
+            half_eps = torch.where(guided.view(-1, 1, 1, 1), half_eps, cond_eps)
 
         eps = torch.cat([half_eps, half_eps], dim=0)
         return torch.cat([eps, rest], dim=1)
@@ -0,0 +1,319 @@
+"""
+Local HTTP sampling service of FlashDiT.
+
+Keeps the EMA weights, VA_VAE and latent statistics resident and serves class-conditional samples.
+Requests are coalesced into batches: the first queued request waits at most --max-wait-ms for others,
+up to --max-batch-size. Each batch runs on the SamplingEngine (transport/engine.py), so requests of one
+batch may have different seeds, cfg scales and step counts. Latent denormalization and VAE decoding
+are the same as in inference.py do_sample.
+
+Endpoints:
+    GET /generate?class=207&seed=0&cfg=4.0&steps=50    PNG bytes (POST with a JSON body works as well)
+    GET /metrics                                       queue depth, latency and batching statistics (JSON)
+    GET /health
+
+Usage:
+    python serve.py --config configs/flashdit_xl_vavae_f16d32.yaml --port 8000
+    python serve.py --config configs/flashdit_xl_vavae_f16d32.yaml --device cpu --max-batch-size 4
+    python tools/load_test_server.py --port 8000 --num-requests 64 --concurrency 16
+"""
+
+import io
+import json
+import math
+import asyncio
+import argparse
+import urllib.parse
+from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from inference import build_model, load_config, print_with_prefix
+from tokenizer.vavae import VA_VAE
+from transport import create_transport, Sampler, SamplingEngine, SampleRequest
+from datasets.img_latent_dataset import ImgLatentDataset
+from training.checkpoint import load_model_weights
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics:
+    """Counters and the latencies of the last `window` requests / batches"""
+    def __init__(self, window=1024):
+        self.start_time = time()
+        self.requests_total = 0
+        self.errors_total = 0
+        self.batches_total = 0
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_seconds = deque(maxlen=window)
+
+    def record_request(self, latency, queue_wait):
+        self.requests_total += 1
+        self.latencies.append(latency)
+        self.queue_waits.append(queue_wait)
+
+    def record_batch(self, size, seconds):
+        self.batches_total += 1
+        self.batch_sizes.append(size)
+        self.batch_seconds.append(seconds)
+
+    def snapshot(self, queue_depth, in_flight):
+        to_ms = lambda v: None if v is None else v * 1e3
+        uptime = time() - self.start_time
+        return {
+            'queue_depth': queue_depth,
+            'in_flight': in_flight,
+            'requests_total': self.requests_total,
+            'errors_total': self.errors_total,
+            'batches_total': self.batches_total,
+            'uptime_seconds': uptime,
+            'images_per_second': self.requests_total / uptime,
+            'mean_batch_size': sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+            'mean_batch_ms': to_ms(sum(self.batch_seconds) / len(self.batch_seconds)) if self.batch_seconds else None,
+            'latency_ms_p50': to_ms(percentile(self.latencies, 0.5)),
+            'latency_ms_p90': to_ms(percentile(self.latencies, 0.9)),
+            'latency_ms_p99': to_ms(percentile(self.latencies, 0.99)),
+            'queue_wait_ms_p50': to_ms(percentile(self.queue_waits, 0.5)),
+            'queue_wait_ms_p90': to_ms(percentile(self.queue_waits, 0.9)),
+        }
+
+
+class SamplingService:
+    """FlashDiT + VA_VAE kept in memory, with an asyncio queue in front of the sampling engine"""
+    def __init__(self, train_config, ckpt_path, device, max_batch_size=16, max_wait_ms=20, max_steps=1000):
+        self.device = torch.device(device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_steps = max_steps
+        if self.device.type == 'cuda':
+            torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_grad_enabled(False)
+
+        # sampling defaults of the config, a request may override cfg and steps
+        self.num_classes = train_config['data']['num_classes']
+        self.cfg_scale = train_config['sample']['cfg_scale']
+        self.num_steps = train_config['sample']['num_sampling_steps']
+        self.timestep_shift = train_config['sample']['timestep_shift'] if 'timestep_shift' in train_config['sample'] else 0
+        cfg_interval_start = train_config['sample']['cfg_interval_start'] if 'cfg_interval_start' in train_config['sample'] else 0
+        assert train_config['sample']['sampling_method'] == 'euler', "the sampling engine integrates with Euler steps"
+
+        self.model = build_model(train_config)
+        self.model.load_state_dict(load_model_weights(ckpt_path, 'ema'))
+        self.model.eval().to(self.device)
+        self.model.disable_block_cache()
+        print_with_prefix('Loaded EMA weights from', ckpt_path)
+
+        self.vae = VA_VAE(f'tokenizer/configs/{train_config["vae"]["model_name"]}.yaml', device=self.device)
+        print_with_prefix('Loaded VAE model')
+
+        dataset = ImgLatentDataset(
+            data_dir=train_config['data']['data_path'],
+            latent_norm=train_config['data']['latent_norm'] if 'latent_norm' in train_config['data'] else False,
+            latent_multiplier=train_config['data']['latent_multiplier'] if 'latent_multiplier' in train_config['data'] else 0.18215,
+        )
+        latent_mean, latent_std = dataset.get_latent_stats()
+        self.latent_mean = latent_mean.clone().detach().to(self.device)
+        self.latent_std = latent_std.clone().detach().to(self.device)
+        self.latent_multiplier = train_config['data']['latent_multiplier'] if 'latent_multiplier' in train_config['data'] else 0.18215
+
+        transport = create_transport(
+            train_config['transport']['path_type'],
+            train_config['transport']['prediction'],
+            train_config['transport']['loss_weight'],
+            train_config['transport']['train_eps'],
+            train_config['transport']['sample_eps'],
+        )
+        latent_size = self.model.x_embedder.img_size[0]
+        self.engine = SamplingEngine(
+            self.model,
+            Sampler(transport),
+            (self.model.in_channels, latent_size, latent_size),
+            batch_size=max_batch_size,
+            cfg_interval_start=cfg_interval_start,
+            device=self.device,
+        )
+
+        # a single worker thread owns the model, the event loop only does I/O and batching
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.in_flight = 0
+        self.metrics = Metrics()
+
+    def parse_request(self, params):
+        """SampleRequest from the query / JSON parameters, ValueError on invalid input"""
+        if 'class' not in params:
+            raise ValueError("missing parameter 'class'")
+        label = int(params['class'])
+        seed = int(params['seed']) if 'seed' in params else 0
+        cfg_scale = float(params['cfg']) if 'cfg' in params else self.cfg_scale
+        num_steps = int(params['steps']) if 'steps' in params else self.num_steps
+        if not 0 <= label < self.num_classes:
+            raise ValueError(f"class must be in [0, {self.num_classes})")
+        if not 2 <= num_steps <= self.max_steps:
+            raise ValueError(f"steps must be in [2, {self.max_steps}]")
+        if not math.isfinite(cfg_scale) or cfg_scale < 0:
+            raise ValueError("cfg must be finite and non-negative")
+        if not 0 <= seed < 2 ** 63:
+            raise ValueError("seed must be in [0, 2**63)")
+        return SampleRequest(label, seed, cfg_scale=cfg_scale, num_steps=num_steps, timestep_shift=self.timestep_shift)
+
+    async def generate(self, request):
+        """Queue a request and wait for its PNG bytes"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future, time()))
+        return await future
+
+    def run_batch(self, requests):
+        """Sample, decode and PNG-encode a batch, runs in the worker thread"""
+        for i, request in enumerate(requests):
+            request.payload = i
+        latents = [None] * len(requests)
+        try:
+            for request, latent in self.engine.run(requests):
+                latents[request.payload] = latent
+        except Exception:
+            # drop the failed batch, so that the next one starts from an empty engine
+            self.engine.reset()
+            raise
+        samples = torch.stack(latents)
+        samples = (samples * self.latent_std) / self.latent_multiplier + self.latent_mean
+        images = self.vae.decode_to_images(samples)
+        pngs = []
+        for image in images:
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format='PNG')
+            pngs.append(buffer.getvalue())
+        return pngs
+
+    async def batcher(self):
+        """Coalesce queued requests: wait for the first one, then at most max_wait for up to max_batch_size"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time()
+            self.in_flight = len(batch)
+            try:
+                pngs = await loop.run_in_executor(self.executor, self.run_batch, [request for request, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.metrics.errors_total += len(batch)
+                continue
+            finally:
+                self.in_flight = 0
+            end = time()
+            self.metrics.record_batch(len(batch), end - start)
+            for (_, future, submitted), png in zip(batch, pngs):
+                self.metrics.record_request(end - submitted, start - submitted)
+                if not future.done():
+                    future.set_result(png)
+
+    async def handle(self, reader, writer):
+        """Minimal HTTP/1.1 handler, one request per connection"""
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers['content-length'])) if 'content-length' in headers else b''
+
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+
+            if url.path == '/generate' and method in ('GET', 'POST'):
+                try:
+                    if method == 'POST' and body:
+                        payload = json.loads(body)
+                        if not isinstance(payload, dict):
+                            raise ValueError("JSON body must be an object")
+                        params.update(payload)
+                    request = self.parse_request(params)
+                except (ValueError, TypeError, OverflowError) as e:
+                    await self.respond(writer, 400, 'application/json', json.dumps({'error': str(e)}).encode())
+                    return
+                png = await self.generate(request)
+                await self.respond(writer, 200, 'image/png', png)
+            elif url.path == '/metrics':
+                metrics = self.metrics.snapshot(self.queue.qsize(), self.in_flight)
+                await self.respond(writer, 200, 'application/json', json.dumps(metrics).encode())
+            elif url.path == '/health':
+                await self.respond(writer, 200, 'text/plain', b'ok')
+            else:
+                await self.respond(writer, 404, 'application/json', json.dumps({'error': 'not found'}).encode())
+        except Exception as e:
+            try:
+                await self.respond(writer, 500, 'application/json', json.dumps({'error': repr(e)}).encode())
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, body):
+        header = (f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                  f"Content-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\n"
+                  f"Connection: close\r\n\r\n")
+        writer.write(header.encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print_with_prefix(f"Serving on http://{host}:{port} (device {self.device}, max batch {self.max_batch_size}, "
+                          f"max wait {self.max_wait * 1e3:.0f}ms)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/flashdit_xl_vavae_f16d32.yaml')
+    parser.add_argument('--ckpt', type=str, default=None, help="checkpoint, defaults to ckpt_path of the config")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=20)
+    parser.add_argument('--max-steps', type=int, default=1000)
+    args = parser.parse_args()
+
+    train_config = load_config(args.config)
+    ckpt_path = args.ckpt if args.ckpt is not None else train_config['ckpt_path']
+    service = SamplingService(train_config, ckpt_path, args.device, max_batch_size=args.max_batch_size,
+                              max_wait_ms=args.max_wait_ms, max_steps=args.max_steps)
+    asyncio.run(service.serve(args.host, args.port))
@@ -4,6 +4,7 @@ from PIL import Image
 from omegaconf import OmegaConf
 from torchvision import transforms
 from tokenizer.autoencoder import AutoencoderKL
+from tokenizer.preprocessing import center_crop_arr, DraftLoader
 
 class MAR_VAE:
     def __init__(self, img_size=256, horizon_flip=0.5, fp16=True):
@@ -32,6 +33,10 @@ class MAR_VAE:
         ]
         return transforms.Compose(img_transforms)
 
+    def img_loader(self, img_size=None):
+        img_size = img_size if img_size is not None else self.img_size
+        return DraftLoader(img_size)
+
     def encode_images(self, images):
         with torch.no_grad():
             posterior = self.model.encode(images.cuda())
@@ -42,19 +47,3 @@ class MAR_VAE:
             images = self.model.decode(z.cuda())
             images = torch.clamp(127.5 * images + 128.0, 0, 255).permute(0, 2, 3, 1).to("cpu", dtype=torch.uint8).numpy()
         return images
-
-def center_crop_arr(pil_image, image_size):
-    while min(*pil_image.size) >= 2 * image_size:
-        pil_image = pil_image.resize(
-            tuple(x // 2 for x in pil_image.size), resample=Image.BOX
-        )
-
-    scale = image_size / min(*pil_image.size)
-    pil_image = pil_image.resize(
-        tuple(round(x * scale) for x in pil_image.size), resample=Image.BICUBIC
-    )
-
-    arr = np.array(pil_image)
-    crop_y = (arr.shape[0] - image_size) // 2
-    crop_x = (arr.shape[1] - image_size) // 2
-    return Image.fromarray(arr[crop_y: crop_y + image_size, crop_x: crop_x + image_size])
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Shared image preprocessing of the tokenizers.
+"""
+
+import numpy as np
+from PIL import Image
+
+
+def center_crop_arr(pil_image, image_size):
+    """
+    Center cropping implementation from ADM.
+    https://github.com/openai/guided-diffusion/blob/8fb3ad9197f16bbc40620447b2742e13458d2831/guided_diffusion/image_datasets.py#L126
+    """
+    while min(*pil_image.size) >= 2 * image_size:
+        pil_image = pil_image.resize(
+            tuple(x // 2 for x in pil_image.size), resample=Image.BOX
+        )
+
+    scale = image_size / min(*pil_image.size)
+    pil_image = pil_image.resize(
+        tuple(round(x * scale) for x in pil_image.size), resample=Image.BICUBIC
+    )
+
+    arr = np.array(pil_image)
+    crop_y = (arr.shape[0] - image_size) // 2
+    crop_x = (arr.shape[1] - image_size) // 2
+    return Image.fromarray(arr[crop_y: crop_y + image_size, crop_x: crop_x + image_size])
+
+
+def draft_open(path, image_size):
+    """
+    Open an image as RGB. JPEGs are decoded at the smallest DCT scale (1/1, 1/2, 1/4, 1/8)
+    that keeps both sides >= 2 * image_size, which replaces the first BOX halvings of center_crop_arr.
+    Other formats are decoded at full resolution.
+    """
+    with open(path, 'rb') as f:
+        pil_image = Image.open(f)
+        if pil_image.format == 'JPEG':
+            pil_image.draft('RGB', (2 * image_size, 2 * image_size))
+        return pil_image.convert('RGB')
+
+
+class DraftLoader:
+    """
+    ImageFolder loader that decodes JPEGs at reduced resolution, see draft_open.
+    A class rather than a lambda so that it can be pickled to DataLoader workers.
+    """
+    def __init__(self, image_size):
+        self.image_size = image_size
+
+    def __call__(self, path):
+        return draft_open(path, self.image_size)
@@ -16,15 +16,18 @@ from PIL import Image
 from omegaconf import OmegaConf
 from torchvision import transforms
 from tokenizer.autoencoder import AutoencoderKL
+from tokenizer.preprocessing import center_crop_arr, DraftLoader
 
 class VA_VAE:
     """Vision Foundation Model Aligned VAE Implementation"""
     
-    def __init__(self, config, img_size=256, horizon_flip=0.5, fp16=True):
+    def __init__(self, config, img_size=256, horizon_flip=0.5, fp16=True, device='cuda'):
         """Initialize VA_VAE
         Args:
             config: Configuration dict containing img_size, horizon_flip and fp16 parameters
+            device: Device the VAE runs on, 'cpu' for CPU-only serving and testing
         """
+        self.device = device
         self.config = OmegaConf.load(config)
         self.embed_dim = self.config.model.params.embed_dim
         self.ckpt_path = self.config.ckpt_path
@@ -38,7 +41,7 @@ class VA_VAE:
             embed_dim=self.embed_dim,
             ch_mult=(1, 1, 2, 2, 4),
             ckpt_path=self.ckpt_path
-        ).cuda().eval()
+        ).to(self.device).eval()
         return self
     
     def img_transform(self, p_hflip=0, img_size=None):
@@ -58,6 +61,16 @@ class VA_VAE:
         ]
         return transforms.Compose(img_transforms)
 
+    def img_loader(self, img_size=None):
+        """Image loader for ImageFolder
+        Args:
+            img_size: Target image size, use default if None
+        Returns:
+            DraftLoader: Loader that decodes JPEGs at reduced resolution before img_transform
+        """
+        img_size = img_size if img_size is not None else self.img_size
+        return DraftLoader(img_size)
+
     def encode_images(self, images):
         """Encode images to latent representations
         Args:
@@ -66,7 +79,7 @@ class VA_VAE:
             torch.Tensor: Encoded latent representation
         """
         with torch.no_grad():
-            posterior = self.model.encode(images.cuda())
+            posterior = self.model.encode(images.to(self.device))
             return posterior.sample()
 
     def decode_to_images(self, z):
@@ -77,30 +90,10 @@ class VA_VAE:
             np.ndarray: Decoded image array
         """
         with torch.no_grad():
-            images = self.model.decode(z.cuda())
+            images = self.model.decode(z.to(self.device))
             images = torch.clamp(127.5 * images + 128.0, 0, 255).permute(0, 2, 3, 1).to("cpu", dtype=torch.uint8).numpy()
         return images
 
-def center_crop_arr(pil_image, image_size):
-    """
-    Center cropping implementation from ADM.
-    https://github.com/openai/guided-diffusion/blob/8fb3ad9197f16bbc40620447b2742e13458d2831/guided_diffusion/image_datasets.py#L126
-    """
-    while min(*pil_image.size) >= 2 * image_size:
-        pil_image = pil_image.resize(
-            tuple(x // 2 for x in pil_image.size), resample=Image.BOX
-        )
-
-    scale = image_size / min(*pil_image.size)
-    pil_image = pil_image.resize(
-        tuple(round(x * scale) for x in pil_image.size), resample=Image.BICUBIC
-    )
-
-    arr = np.array(pil_image)
-    crop_y = (arr.shape[0] - image_size) // 2
-    crop_x = (arr.shape[1] - image_size) // 2
-    return Image.fromarray(arr[crop_y: crop_y + image_size, crop_x: crop_x + image_size])
-
 
 if __name__ == "__main__":
     vae = VA_VAE('tokenizer/configs/vavae_f16d32_vfdinov2.yaml')
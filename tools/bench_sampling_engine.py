@@ -0,0 +1,154 @@
+"""
+Throughput of the continuous-batching SamplingEngine (transport/engine.py) against the fixed-batch loop of
+inference.py do_sample, on a heterogeneous workload of requests with their own label, seed, cfg scale,
+step count and timestep shift. The model has random weights, only the sampling schedule is measured.
+
+The fixed-batch loop can only share one cfg scale and one time grid per batch, so the requests are
+grouped by (cfg scale, steps, shift) and every group runs in batches of --batch-size, with the
+duplicated null-class half of forward_with_cfg. Both paths use the same per-request noise, so the
+outputs are also compared.
+
+Usage:
+    python tools/bench_sampling_engine.py --device cuda --num-requests 256 --batch-size 32
+"""
+
+import os
+import sys
+import random
+import argparse
+from time import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.flashdit import FlashDiT
+from transport import create_transport, Sampler, SamplingEngine, SampleRequest
+
+
+def build_model(args, device):
+    torch.manual_seed(0)
+    model = FlashDiT(
+        input_size=args.latent_size,
+        patch_size=1,
+        in_channels=args.in_chans,
+        hidden_size=args.hidden_size,
+        depth=args.depth,
+        num_heads=args.num_heads,
+        num_classes=args.num_classes,
+        use_swiglu=True,
+        use_rmsnorm=True,
+        window_size=args.window_size,
+    ).to(device)
+    # the final layer is zero-initialized, give it weights so that the outputs can be compared
+    for p in model.final_layer.parameters():
+        torch.nn.init.normal_(p, std=0.02)
+    return model.eval()
+
+
+def make_requests(args):
+    rng = random.Random(args.seed)
+    return [
+        SampleRequest(
+            label=rng.randrange(args.num_classes),
+            seed=i,
+            cfg_scale=rng.choice(args.cfg_scales),
+            num_steps=rng.choice(args.steps),
+            timestep_shift=rng.choice(args.shifts),
+            payload=i,
+        )
+        for i in range(args.num_requests)
+    ]
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run_engine(model, sampler, requests, latent_shape, args, device):
+    engine = SamplingEngine(model, sampler, latent_shape, batch_size=args.batch_size,
+                            cfg_interval_start=args.cfg_interval_start, device=device)
+    outputs = {}
+    sync(device)
+    start = time()
+    for request, latent in engine.run(requests):
+        outputs[request.payload] = latent
+    sync(device)
+    return outputs, time() - start, engine.model_rows, engine.model_calls
+
+
+@torch.no_grad()
+def run_fixed_batches(model, sampler, requests, latent_shape, args, device):
+    engine = SamplingEngine(model, sampler, latent_shape, batch_size=1, device=device)  # for the seeded noise only
+    groups = {}
+    for request in requests:
+        groups.setdefault((request.cfg_scale, request.num_steps, request.timestep_shift), []).append(request)
+    outputs, calls = {}, []
+    # forward_with_cfg calls forward directly, so the rows are counted at the patch embedding
+    hook = model.x_embedder.register_forward_pre_hook(lambda module, inputs: calls.append(inputs[0].shape[0]))
+
+    sync(device)
+    start = time()
+    for (cfg_scale, num_steps, shift), group in groups.items():
+        sample_fn = sampler.sample_ode(sampling_method='euler', num_steps=num_steps, timestep_shift=shift)
+        for i in range(0, len(group), args.batch_size):
+            batch = group[i:i + args.batch_size]
+            z = torch.stack([engine._noise(r.seed) for r in batch])
+            y = torch.tensor([r.label for r in batch], device=device)
+            if cfg_scale > 1.0:
+                z = torch.cat([z, z], 0)
+                y = torch.cat([y, torch.full_like(y, args.num_classes)], 0)
+                model_kwargs = dict(y=y, cfg_scale=cfg_scale, cfg_interval=True, cfg_interval_start=args.cfg_interval_start)
+                samples = sample_fn(z, model.forward_with_cfg, **model_kwargs)[-1][:len(batch)]
+            else:
+                samples = sample_fn(z, model.forward, y=y)[-1]
+            for r, latent in zip(batch, samples):
+                outputs[r.payload] = latent
+    sync(device)
+    hook.remove()
+    return outputs, time() - start, sum(calls), len(calls)
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = build_model(args, device)
+    transport = create_transport('Linear', 'velocity', None, None, None)
+    sampler = Sampler(transport)
+    latent_shape = (args.in_chans, args.latent_size, args.latent_size)
+    requests = make_requests(args)
+    print(f"{len(requests)} requests, cfg scales {args.cfg_scales}, steps {args.steps}, shifts {args.shifts}")
+
+    # warmup
+    run_engine(model, sampler, requests[:args.batch_size], latent_shape, args, device)
+
+    fixed, fixed_seconds, fixed_rows, fixed_calls = run_fixed_batches(model, sampler, requests, latent_shape, args, device)
+    print(f"fixed batches:   {fixed_seconds:7.2f}s, {len(requests) / fixed_seconds:7.2f} images/sec, "
+          f"{fixed_calls} model calls, {fixed_rows / fixed_calls:6.1f} rows/call")
+    engine, engine_seconds, engine_rows, engine_calls = run_engine(model, sampler, requests, latent_shape, args, device)
+    print(f"sampling engine: {engine_seconds:7.2f}s, {len(requests) / engine_seconds:7.2f} images/sec, "
+          f"{engine_calls} model calls, {engine_rows / engine_calls:6.1f} rows/call "
+          f"({fixed_seconds / engine_seconds:.2f}x)")
+
+    max_diff = max((engine[i] - fixed[i]).abs().max().item() for i in engine)
+    print(f"max abs diff between the two paths: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--num-requests", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--cfg-scales", type=float, nargs='+', default=[1.0, 4.0, 6.7])
+    parser.add_argument("--steps", type=int, nargs='+', default=[25, 50, 100])
+    parser.add_argument("--shifts", type=float, nargs='+', default=[0.0, 0.3])
+    parser.add_argument("--cfg-interval-start", type=float, default=0.11)
+    parser.add_argument("--latent-size", type=int, default=16)
+    parser.add_argument("--in-chans", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=384)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--num-heads", type=int, default=6)
+    parser.add_argument("--window-size", type=int, default=8)
+    parser.add_argument("--num-classes", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of the window shuffle in FlashDiTBlock.
+Compares the rearrange -> window_partition -> window_reverse -> restore path
+against the precomputed token permutation plan (one gather each way),
+and checks that both produce bit-identical block outputs.
+
+Usage:
+    python tools/bench_token_plan.py --device cuda --batch-size 32
+"""
+
+import os
+import sys
+import argparse
+from time import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.flashdit import FlashDiTBlock, build_token_plan
+
+# (hidden_size, num_heads) of FlashDiT-B and FlashDiT-XL
+MODEL_DIMS = {
+    'FlashDiT-B': (768, 12),
+    'FlashDiT-XL': (1152, 16),
+}
+# image resolution -> latent resolution with the f16 VA-VAE and patch size 1
+RESOLUTIONS = {256: 16, 512: 32}
+
+
+def time_block(block, x, c, token_plan, iters, device):
+    for _ in range(3):
+        block(x, c, None, token_plan)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time()
+    for _ in range(iters):
+        block(x, c, None, token_plan)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time() - start) / iters
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    for name, (hidden_size, num_heads) in MODEL_DIMS.items():
+        block = FlashDiTBlock(hidden_size, num_heads, use_swiglu=True, use_rmsnorm=True, window_size=args.window_size)
+        # adaLN is zero-initialized in FlashDiT; use random weights so the attention path contributes
+        torch.nn.init.normal_(block.adaLN_modulation[-1].weight, std=0.02)
+        block = block.to(device).eval()
+        for image_size, latent_size in RESOLUTIONS.items():
+            N = latent_size * latent_size
+            x = torch.randn(args.batch_size, N, hidden_size, device=device)
+            c = torch.randn(args.batch_size, hidden_size, device=device)
+            token_plan = build_token_plan(latent_size, latent_size, block.window_size, device=device)
+
+            identical = torch.equal(block(x, c, None, None), block(x, c, None, token_plan))
+            t_ref = time_block(block, x, c, None, args.iters, device)
+            t_plan = time_block(block, x, c, token_plan, args.iters, device)
+            print(f"{name} {image_size}px ({latent_size}x{latent_size} tokens): "
+                  f"reference {t_ref * 1e3:.3f} ms, token plan {t_plan * 1e3:.3f} ms, "
+                  f"speedup {t_ref / t_plan:.2f}x, bit-identical={identical}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--window-size", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+    main(args)
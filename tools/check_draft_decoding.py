@@ -0,0 +1,60 @@
+"""
+Tolerance check of JPEG draft decoding against the full-resolution center_crop_arr pipeline.
+Reports mean / max absolute pixel error, PSNR and decode time, and fails if the mean error exceeds --tol.
+
+Usage:
+    python tools/check_draft_decoding.py --data_path /path/to/ImageNet/val --num_images 500
+"""
+
+import os
+import sys
+import argparse
+from glob import glob
+from time import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tokenizer.preprocessing import center_crop_arr, draft_open
+
+
+def main(args):
+    paths = sorted(glob(os.path.join(args.data_path, '**', '*.JPEG'), recursive=True)
+                   + glob(os.path.join(args.data_path, '**', '*.jpg'), recursive=True))[:args.num_images]
+    assert len(paths) > 0, f"no JPEG images found in {args.data_path}"
+
+    mean_errors, max_errors, psnrs = [], [], []
+    time_full, time_draft = 0.0, 0.0
+    for path in paths:
+        start = time()
+        ref = np.asarray(center_crop_arr(Image.open(path).convert('RGB'), args.image_size), dtype=np.float64)
+        time_full += time() - start
+        start = time()
+        out = np.asarray(center_crop_arr(draft_open(path, args.image_size), args.image_size), dtype=np.float64)
+        time_draft += time() - start
+
+        err = np.abs(ref - out)
+        mse = (err ** 2).mean()
+        mean_errors.append(err.mean())
+        max_errors.append(err.max())
+        psnrs.append(10 * np.log10(255.0 ** 2 / mse) if mse > 0 else float('inf'))
+
+    mean_error = float(np.mean(mean_errors))
+    print(f"{len(paths)} images at {args.image_size}px")
+    print(f"mean abs error {mean_error:.3f}, max abs error {np.max(max_errors):.0f}, median PSNR {np.median(psnrs):.2f} dB")
+    print(f"decode + crop: full {time_full / len(paths) * 1e3:.2f} ms/img, draft {time_draft / len(paths) * 1e3:.2f} ms/img "
+          f"({time_full / time_draft:.2f}x)")
+    if mean_error > args.tol:
+        print(f"FAILED: mean abs error {mean_error:.3f} > tolerance {args.tol}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True)
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument("--num_images", type=int, default=500)
+    parser.add_argument("--tol", type=float, default=2.0, help="max allowed mean absolute error in [0, 255] pixel values")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,90 @@
+"""
+Loopback load test of the sampling service (serve.py).
+
+Sends --num-requests /generate requests from --concurrency concurrent clients with random classes and seeds,
+checks that every response is a PNG and reports throughput, client-side latency percentiles and the
+server's /metrics afterwards. Only uses the standard library, so it runs next to a CPU-only server.
+
+Usage:
+    python serve.py --config configs/flashdit_xl_vavae_f16d32.yaml --device cpu --max-batch-size 4 &
+    python tools/load_test_server.py --port 8000 --num-requests 32 --concurrency 8 --steps 10
+"""
+
+import json
+import random
+import asyncio
+import argparse
+from time import time
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+
+async def http_get(host, port, target):
+    """GET over a fresh connection, returns (status, body)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    header, _, body = response.partition(b'\r\n\r\n')
+    status = int(header.split(b' ', 2)[1])
+    return status, body
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    queue = asyncio.Queue()
+    for i in range(args.num_requests):
+        params = f"class={rng.randrange(args.num_classes)}&seed={rng.randrange(2 ** 31)}"
+        if args.cfg is not None:
+            params += f"&cfg={rng.choice(args.cfg)}"
+        if args.steps is not None:
+            params += f"&steps={rng.choice(args.steps)}"
+        queue.put_nowait(f"/generate?{params}")
+
+    latencies, failures = [], []
+
+    async def client():
+        while not queue.empty():
+            target = queue.get_nowait()
+            start = time()
+            status, body = await http_get(args.host, args.port, target)
+            if status != 200 or not body.startswith(PNG_MAGIC):
+                failures.append((target, status, body[:200]))
+            else:
+                latencies.append(time() - start)
+
+    start = time()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    seconds = time() - start
+
+    print(f"{len(latencies)} / {args.num_requests} requests succeeded in {seconds:.2f}s, "
+          f"{len(latencies) / seconds:.2f} images/sec with {args.concurrency} concurrent clients")
+    if latencies:
+        print(f"client latency: p50 {percentile(latencies, 0.5) * 1e3:.0f}ms, p90 {percentile(latencies, 0.9) * 1e3:.0f}ms, "
+              f"p99 {percentile(latencies, 0.99) * 1e3:.0f}ms")
+    for target, status, body in failures[:5]:
+        print(f"failed: {target} -> {status} {body!r}")
+
+    status, body = await http_get(args.host, args.port, '/metrics')
+    print("server metrics:", json.dumps(json.loads(body), indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--num-classes", type=int, default=1000)
+    # each request picks one of the given values, the server's config defaults are used if not set
+    parser.add_argument("--cfg", type=float, nargs='+', default=None)
+    parser.add_argument("--steps", type=int, nargs='+', default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -22,6 +22,7 @@ import numpy as np
 import logging
 import os
 import argparse
+from contextlib import nullcontext
 from time import time
 from glob import glob
 from copy import deepcopy
@@ -32,9 +33,15 @@ from tqdm import tqdm
 from diffusers.models import AutoencoderKL
 # from models.lightningdit import LightningDiT_models
 from models.flashdit import FlashDiT_models
+from models.ema import ForeachEMA
+from training.step_timer import StepTimer
+from training.micro_batch import find_micro_batch_size
+from training.activation_checkpointing import plan_activation_checkpointing, plan_micro_batch_and_checkpointing
+from training.checkpoint import AsyncCheckpointer, find_resume_checkpoint, load_training_state, get_rng_state, set_rng_state
 from transport import create_transport, Sampler
 from accelerate import Accelerator
 from datasets.img_latent_dataset import ImgLatentDataset
+from datasets.shard_sampler import ShardBlockSampler
 
 def do_train(train_config, accelerator):
     """
@@ -87,8 +94,18 @@ def do_train(train_config, accelerator):
         in_channels=train_config['model']['in_chans'] if 'in_chans' in train_config['model'] else 4,
         use_checkpoint=train_config['model']['use_checkpoint'] if 'use_checkpoint' in train_config['model'] else False,
     )
+    # selective activation checkpointing: 'none', 'attn', 'mlp' or 'full' on every checkpoint_every-th block,
+    # or 'auto' to plan per block for checkpoint_memory_budget (see below). use_checkpoint is the same as 'full'.
+    checkpoint_policy = train_config['model']['checkpoint_policy'] if 'checkpoint_policy' in train_config['model'] else None
+    if checkpoint_policy is not None and checkpoint_policy != 'auto':
+        model.set_checkpoint_policy(
+            checkpoint_policy,
+            every=train_config['model']['checkpoint_every'] if 'checkpoint_every' in train_config['model'] else 1,
+        )
 
-    ema = deepcopy(model).to(device)  # Create an EMA of the model for use after training
+    # EMA can be kept on CPU to free accelerator memory, then it is best updated every few steps
+    ema_on_cpu = train_config['train']['ema_on_cpu'] if 'ema_on_cpu' in train_config['train'] else False
+    ema = deepcopy(model).to('cpu' if ema_on_cpu else device)  # Create an EMA of the model for use after training
 
     # load pretrained model
     if 'weight_init' in train_config['train']:
@@ -110,12 +127,17 @@ def do_train(train_config, accelerator):
         train_config['transport']['sample_eps'],
         use_cosine_loss = train_config['transport']['use_cosine_loss'] if 'use_cosine_loss' in train_config['transport'] else False,
         use_lognorm = train_config['transport']['use_lognorm'] if 'use_lognorm' in train_config['transport'] else False,
+        samples_per_latent = train_config['transport']['samples_per_latent'] if 'samples_per_latent' in train_config['transport'] else 1,
+        timestep_distribution = train_config['transport']['timestep_distribution'] if 'timestep_distribution' in train_config['transport'] else None,
+        seed = train_config['train']['global_seed'] * accelerator.num_processes + accelerator.process_index,
+        fused_loss = train_config['transport']['fused_loss'] if 'fused_loss' in train_config['transport'] else False,
     )  # default: velocity; 
     if accelerator.is_main_process:
         logger.info(f"FlashDiT Parameters: {sum(p.numel() for p in model.parameters()) / 1e6:.2f}M")
         logger.info(f"Optimizer: AdamW, lr={train_config['optimizer']['lr']}, beta2={train_config['optimizer']['beta2']}")
-        logger.info(f'Use lognorm sampling: {train_config["transport"]["use_lognorm"]}')
+        logger.info(f'Timestep distribution: {type(transport.timestep_dist).__name__} {vars(transport.timestep_dist)}')
         logger.info(f'Use cosine loss: {train_config["transport"]["use_cosine_loss"]}')
+        logger.info(f'Timestep / noise draws per latent: {transport.samples_per_latent}')
     opt = torch.optim.AdamW(model.parameters(), lr=train_config['optimizer']['lr'], weight_decay=0, betas=(0.9, train_config['optimizer']['beta2']))
     
     # Setup data
@@ -126,10 +148,85 @@ def do_train(train_config, accelerator):
     )
     batch_size_per_gpu = int(np.round(train_config['train']['global_batch_size'] / accelerator.num_processes))
     global_batch_size = batch_size_per_gpu * accelerator.num_processes
+    # gradient accumulation: an optimizer step sees batch_size_per_gpu samples per gpu in grad_accum_steps micro-batches.
+    # 'auto' probes the largest micro-batch that fits into memory.
+    grad_accum_steps = train_config['train']['grad_accum_steps'] if 'grad_accum_steps' in train_config['train'] else 1
+    input_shape = (train_config['model']['in_chans'] if 'in_chans' in train_config['model'] else 4, latent_size, latent_size)
+    if checkpoint_policy == 'auto':
+        # budget of the checkpoint plan in GiB, default 90% of device memory
+        if 'checkpoint_memory_budget' in train_config['model']:
+            memory_budget = train_config['model']['checkpoint_memory_budget'] * 1024 ** 3
+        else:
+            memory_budget = 0.9 * torch.cuda.get_device_properties(device).total_memory
+    if grad_accum_steps == 'auto' and checkpoint_policy == 'auto':
+        # largest micro-batch that fits with its cheapest checkpoint plan, probed under that plan
+        micro_batch_size, checkpoint_plan = plan_micro_batch_and_checkpointing(
+            model.module,
+            transport,
+            batch_size_per_gpu,
+            input_shape=input_shape,
+            num_classes=train_config['data']['num_classes'],
+            device=device,
+            autocast=accelerator.autocast,
+            memory_budget=memory_budget,
+        )
+        # run the micro-batch size and plan of rank 0 everywhere
+        micro_batch_and_plan = [(micro_batch_size, checkpoint_plan)]
+        dist.broadcast_object_list(micro_batch_and_plan, src=0)
+        micro_batch_size, checkpoint_plan = micro_batch_and_plan[0]
+        model.module.set_checkpoint_plan(checkpoint_plan)
+        grad_accum_steps = batch_size_per_gpu // micro_batch_size
+    elif grad_accum_steps == 'auto':
+        micro_batch_size = find_micro_batch_size(
+            model.module,
+            transport,
+            batch_size_per_gpu,
+            input_shape=input_shape,
+            num_classes=train_config['data']['num_classes'],
+            device=device,
+            autocast=accelerator.autocast,
+        )
+        # all ranks have to run the same micro-batch size
+        micro_batch_size = torch.tensor(micro_batch_size, device=device)
+        dist.all_reduce(micro_batch_size, op=dist.ReduceOp.MIN)
+        micro_batch_size = micro_batch_size.item()
+        grad_accum_steps = batch_size_per_gpu // micro_batch_size
+    else:
+        assert batch_size_per_gpu % grad_accum_steps == 0, "Batch size per gpu must be divisible by grad_accum_steps."
+        micro_batch_size = batch_size_per_gpu // grad_accum_steps
+        if checkpoint_policy == 'auto':
+            # cheapest checkpoint plan for the fixed micro-batch
+            checkpoint_plan = plan_activation_checkpointing(
+                model.module,
+                transport,
+                micro_batch_size,
+                input_shape=input_shape,
+                num_classes=train_config['data']['num_classes'],
+                device=device,
+                autocast=accelerator.autocast,
+                memory_budget=memory_budget,
+            )
+            assert checkpoint_plan is not None, f"even full checkpointing does not fit into the budget of {memory_budget} bytes"
+            # run the plan of rank 0 everywhere
+            checkpoint_plan = [checkpoint_plan]
+            dist.broadcast_object_list(checkpoint_plan, src=0)
+            model.module.set_checkpoint_plan(checkpoint_plan[0])
+    # shard-aware block shuffling, block size trades randomness for sequential reads
+    # without shuffle_block_size it is a full shuffle. The order only depends on (seed, epoch), which makes resume exact.
+    shuffle_block_size = train_config['data']['shuffle_block_size'] if 'shuffle_block_size' in train_config['data'] else None
+    sampler = ShardBlockSampler(
+        dataset.file_offsets,
+        block_size=shuffle_block_size if shuffle_block_size is not None else 1,
+        shards_per_group=train_config['data']['shuffle_shards_per_group'] if shuffle_block_size is not None and 'shuffle_shards_per_group' in train_config['data'] else len(dataset.files),
+        num_replicas=accelerator.num_processes,
+        rank=accelerator.process_index,
+        seed=train_config['train']['global_seed'],
+    )
     loader = DataLoader(
         dataset,
-        batch_size=batch_size_per_gpu,
-        shuffle=True,
+        batch_size=micro_batch_size,
+        shuffle=False,
+        sampler=sampler,
         num_workers=train_config['data']['num_workers'],
         pin_memory=True,
         drop_last=True
@@ -137,6 +234,9 @@ def do_train(train_config, accelerator):
     if accelerator.is_main_process:
         logger.info(f"Dataset contains {len(dataset):,} images {train_config['data']['data_path']}")
         logger.info(f"Batch size {batch_size_per_gpu} per gpu, with {global_batch_size} global batch size")
+        logger.info(f"Micro-batch size {micro_batch_size} with {grad_accum_steps} gradient accumulation steps")
+        if shuffle_block_size is not None:
+            logger.info(f"Shard block shuffling with block size {shuffle_block_size}")
     
     if 'valid_path' in train_config['data']:
         valid_dataset = ImgLatentDataset(
@@ -146,7 +246,7 @@ def do_train(train_config, accelerator):
         )
         valid_loader = DataLoader(
             valid_dataset,
-            batch_size=batch_size_per_gpu,
+            batch_size=micro_batch_size,
             shuffle=True,
             num_workers=train_config['data']['num_workers'],
             pin_memory=True,
@@ -156,68 +256,140 @@ def do_train(train_config, accelerator):
             logger.info(f"Validation Dataset contains {len(valid_dataset):,} images {train_config['data']['valid_path']}")
 
     # Prepare models for training:
-    update_ema(ema, model.module, decay=0)  # Ensure EMA is initialized with synced weights
+    ema_updater = ForeachEMA(
+        ema,
+        model.module,
+        decay=train_config['train']['ema_decay'] if 'ema_decay' in train_config['train'] else 0.9999,
+        update_every=train_config['train']['ema_update_every'] if 'ema_update_every' in train_config['train'] else 1,
+    )
+    ema_updater.update(decay=0)  # Ensure EMA is initialized with synced weights
     model.train()  # important! This enables embedding dropout for classifier-free guidance
     ema.eval()  # EMA model should always be in eval mode
     
     train_config['train']['resume'] = train_config['train']['resume'] if 'resume' in train_config['train'] else False
 
+    train_steps = 0
+    epoch = 0
+    samples_in_epoch = 0  # samples this rank consumed in the current epoch
+    resume_rng_state = None
     if train_config['train']['resume']:
-        # check if the checkpoint exists
-        checkpoint_files = glob(f"{checkpoint_dir}/*.pt")
-        if checkpoint_files:
-            checkpoint_files.sort(key=lambda x: os.path.getsize(x))
-            latest_checkpoint = checkpoint_files[-1]
-            checkpoint = torch.load(latest_checkpoint, map_location=lambda storage, loc: storage)
-            model.load_state_dict(checkpoint['model'])
-            # opt.load_state_dict(checkpoint['opt'])
-            ema.load_state_dict(checkpoint['ema'])
-            train_steps = int(latest_checkpoint.split('/')[-1].split('.')[0])
+        # latest complete checkpoint by step, checkpoint directories or legacy .pt files
+        latest_checkpoint = find_resume_checkpoint(checkpoint_dir)
+        if latest_checkpoint is not None:
+            state = load_training_state(latest_checkpoint, accelerator.process_index, accelerator.num_processes)
+            model.module.load_state_dict(state['model'])
+            ema.load_state_dict(state['ema'])
+            if state['opt'] is not None:
+                opt.load_state_dict(state['opt'])
+            elif accelerator.is_main_process:
+                logger.warning(f"{latest_checkpoint} holds no optimizer state, the optimizer starts fresh.")
+            train_steps = state['step']
+            ema_updater.num_steps = train_steps
+            if state['extra'] is not None:
+                epoch = state['extra']['epoch']
+                samples_in_epoch = state['extra']['samples_in_epoch']
+                resume_rng_state = state['extra']['rng']
+                transport.get_generator(device).set_state(state['extra']['timestep_rng'])
+                transport.timestep_dist.load_state_dict(state['extra']['timestep_dist'])
+            else:
+                # legacy .pt or written with another world size, continue at the same sample count in a fresh RNG stream
+                steps_per_epoch = len(sampler) // micro_batch_size // grad_accum_steps
+                epoch, steps_in_epoch = divmod(train_steps, steps_per_epoch)
+                samples_in_epoch = steps_in_epoch * batch_size_per_gpu
             if accelerator.is_main_process:
-                logger.info(f"Resuming training from checkpoint: {latest_checkpoint}")
+                logger.info(f"Resuming training from checkpoint: {latest_checkpoint} (epoch {epoch}, sample {samples_in_epoch} per gpu)")
         else:
             if accelerator.is_main_process:
                 logger.info("No checkpoint found. Starting training from scratch.")
-    model, opt, loader = accelerator.prepare(model, opt, loader)
+    # ShardBlockSampler already splits the data over ranks, do not let accelerate re-shard the batches
+    model, opt = accelerator.prepare(model, opt)
+    if resume_rng_state is not None:
+        set_rng_state(resume_rng_state)
+
+    # checkpoints are snapshotted to pinned host memory and written in the background
+    checkpointer = AsyncCheckpointer(checkpoint_dir, accelerator.process_index, accelerator.num_processes)
 
     # Variables for monitoring/logging purposes:
-    if not train_config['train']['resume']:
-        train_steps = 0
     log_steps = 0
-    running_loss = 0
+    # accumulated on device, only reduced and read back at log time
+    running_loss = torch.zeros((), device=device)
+    timer = StepTimer(device)
+    # masked-token training: blocks only see (1 - mask_ratio) of the windows, the last
+    # mask_finetune_steps steps train unmasked to close the train / inference gap
+    mask_ratio = train_config['train']['mask_ratio'] if 'mask_ratio' in train_config['train'] else 0.0
+    mask_finetune_steps = train_config['train']['mask_finetune_steps'] if 'mask_finetune_steps' in train_config['train'] else 0
+    flops_per_sample = accelerator.unwrap_model(model).flops_per_sample()
+    masked_flops_per_sample = accelerator.unwrap_model(model).flops_per_sample(mask_ratio)
+    # every latent of the data batch is expanded to samples_per_latent model inputs
+    tokens_per_sample = accelerator.unwrap_model(model).x_embedder.num_patches * transport.samples_per_latent
     start_time = time()
-    use_checkpoint = train_config['train']['use_checkpoint'] if 'use_checkpoint' in train_config['train'] else True
     if accelerator.is_main_process:
-        logger.info(f"Using checkpointing: {use_checkpoint}")
+        logger.info(f"Activation checkpointing per block: {accelerator.unwrap_model(model).checkpoint_plan}")
+        logger.info(f"Estimated forward GFLOPs per sample: {flops_per_sample / 1e9:.2f}")
+        if mask_ratio > 0:
+            logger.info(f"Masked-token training with mask ratio {mask_ratio} ({masked_flops_per_sample / 1e9:.2f} GFLOPs per sample), "
+                        f"unmasked for the last {mask_finetune_steps} steps")
 
     while True:
-        for x, y in loader:
-            if accelerator.mixed_precision == 'no':
-                x = x.to(device, dtype=torch.float32)
-                y = y
-            else:
-                x = x.to(device)
-                y = y.to(device)
-            model_kwargs = dict(y=y)
-            loss_dict = transport.training_losses(model, x, model_kwargs)
-            if 'cos_loss' in loss_dict:
-                mse_loss = loss_dict["loss"].mean()
-                loss = loss_dict["cos_loss"].mean() + mse_loss
-            else:
-                loss = loss_dict["loss"].mean()
+        sampler.set_epoch(epoch)
+        # fast-forward a resumed epoch, skipped samples are never loaded
+        sampler.set_start_index(samples_in_epoch)
+        data_iter = iter(loader)
+        while True:
             opt.zero_grad()
-            accelerator.backward(loss)
-            if 'max_grad_norm' in train_config['optimizer']:
-                if accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(model.parameters(), train_config['optimizer']['max_grad_norm'])
-            opt.step()
-            update_ema(ema, model.module)
+            step_loss = torch.zeros((), device=device)
+            masked_step = mask_ratio > 0 and train_steps < train_config['train']['max_steps'] - mask_finetune_steps
+            for micro_step in range(grad_accum_steps):
+                with timer.host_phase('data'):
+                    batch = next(data_iter, None)
+                    if batch is None:
+                        break
+                    x, y = batch
+                    if accelerator.mixed_precision == 'no':
+                        x = x.to(device, dtype=torch.float32)
+                        y = y.to(device)
+                    else:
+                        x = x.to(device)
+                        y = y.to(device)
+                model_kwargs = dict(y=y)
+                loss_mask = None
+                if masked_step:
+                    ids_keep = accelerator.unwrap_model(model).sample_token_mask(x.shape[0], mask_ratio, device)
+                    model_kwargs['ids_keep'] = ids_keep
+                    loss_mask = accelerator.unwrap_model(model).token_mask_to_latent(ids_keep)
+                # DDP only all-reduces gradients on the last micro-batch of an optimizer step
+                with nullcontext() if micro_step == grad_accum_steps - 1 else accelerator.no_sync(model):
+                    with timer.phase('forward'):
+                        loss_dict = transport.training_losses(model, x, model_kwargs, loss_mask=loss_mask)
+                        if 'cos_loss' in loss_dict:
+                            mse_loss = loss_dict["loss"].mean()
+                            loss = loss_dict["cos_loss"].mean() + mse_loss
+                        else:
+                            loss = loss_dict["loss"].mean()
+                    with timer.phase('backward'):
+                        accelerator.backward(loss / grad_accum_steps)
+                # Log loss values:
+                if 'cos_loss' in loss_dict:
+                    step_loss += mse_loss.detach() / grad_accum_steps
+                else:
+                    step_loss += loss.detach() / grad_accum_steps
+                samples_in_epoch += micro_batch_size
+            if batch is None:
+                # end of epoch, the gradients of an incomplete accumulation are discarded
+                break
+            with timer.phase('optimizer'):
+                if 'max_grad_norm' in train_config['optimizer']:
+                    if accelerator.sync_gradients:
+                        accelerator.clip_grad_norm_(model.parameters(), train_config['optimizer']['max_grad_norm'])
+                opt.step()
+            with timer.phase('ema'):
+                ema_updater.step()
 
-            # Log loss values:
-            if 'cos_loss' in loss_dict:
-                running_loss += mse_loss.item()
-            else:
-                running_loss += loss.item()
+            running_loss += step_loss
+            # adaptive timestep sampling merges the bucket losses of all ranks every sync_every steps
+            if transport.timestep_dist.sync_every > 0 and (train_steps + 1) % transport.timestep_dist.sync_every == 0:
+                transport.timestep_dist.sync()
+            timer.step()
             log_steps += 1
             train_steps += 1
             if train_steps % train_config['train']['log_every'] == 0:
@@ -225,32 +397,53 @@ def do_train(train_config, accelerator):
                 torch.cuda.synchronize()
                 end_time = time()
                 steps_per_sec = log_steps / (end_time - start_time)
+                samples_per_sec = steps_per_sec * global_batch_size
+                # forward + backward ~ 3x forward FLOPs, reported per device
+                tflops_per_device = 3 * (masked_flops_per_sample if masked_step else flops_per_sample) * transport.samples_per_latent \
+                    * samples_per_sec / accelerator.num_processes / 1e12
+                step_times = timer.summary()
                 # Reduce loss history over all processes:
-                avg_loss = torch.tensor(running_loss / log_steps, device=device)
+                avg_loss = running_loss / log_steps
                 dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
                 avg_loss = avg_loss.item() / dist.get_world_size()
                 if accelerator.is_main_process:
-                    logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}")
+                    logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}, "
+                                f"Tokens/Sec: {samples_per_sec * tokens_per_sample:.0f}, TFLOPs/device: {tflops_per_device:.1f}")
+                    logger.info("Step time (ms): " + ", ".join(f"{name}={ms:.1f}" for name, ms in step_times.items()))
                     writer.add_scalar('Loss/train', avg_loss, train_steps)
+                    writer.add_scalar('Throughput/steps_per_sec', steps_per_sec, train_steps)
+                    writer.add_scalar('Throughput/tokens_per_sec', samples_per_sec * tokens_per_sample, train_steps)
+                    writer.add_scalar('Throughput/tflops_per_device', tflops_per_device, train_steps)
+                    for name, ms in step_times.items():
+                        writer.add_scalar(f'StepTime/{name}_ms', ms, train_steps)
+                    timestep_summary = transport.timestep_dist.summary()
+                    if timestep_summary is not None:
+                        add_timestep_histogram(writer, 'Timesteps/probability', timestep_summary['edges'], timestep_summary['probs'], train_steps)
+                        add_timestep_histogram(writer, 'Timesteps/loss_estimate', timestep_summary['edges'], timestep_summary['loss'], train_steps)
                 # Reset monitoring variables:
-                running_loss = 0
+                running_loss.zero_()
                 log_steps = 0
                 start_time = time()
 
             # Save checkpoint:
             if train_steps % train_config['train']['ckpt_every'] == 0 and train_steps > 0:
-                if accelerator.is_main_process:
-                    checkpoint = {
-                        "model": model.module.state_dict(),
-                        "ema": ema.state_dict(),
-                        "opt": opt.state_dict(),
-                        "config": train_config,
-                    }
-                    checkpoint_path = f"{checkpoint_dir}/{train_steps:07d}.pt"
-                    torch.save(checkpoint, checkpoint_path)
+                with timer.host_phase('checkpoint'):
+                    checkpoint_path = checkpointer.save(
+                        train_steps,
+                        model_state=accelerator.unwrap_model(model).state_dict(),
+                        ema_state=ema.state_dict(),
+                        opt_state=opt.state_dict(),
+                        config=train_config,
+                        extra_state={
+                            'epoch': epoch,
+                            'samples_in_epoch': samples_in_epoch,
+                            'rng': get_rng_state(),
+                            'timestep_rng': transport.get_generator(device).get_state(),
+                            'timestep_dist': transport.timestep_dist.state_dict(),
+                        },
+                    )
                     if accelerator.is_main_process:
-                        logger.info(f"Saved checkpoint to {checkpoint_path}")
-                dist.barrier()
+                        logger.info(f"Saving checkpoint to {checkpoint_path} in the background")
 
                 # Evaluate on validation set
                 if 'valid_path' in train_config['data']:
@@ -267,12 +460,33 @@ def do_train(train_config, accelerator):
                 break
         if train_steps >= train_config['train']['max_steps']:
             break
+        epoch += 1
+        samples_in_epoch = 0
 
+    checkpointer.wait()
     if accelerator.is_main_process:
         logger.info("Done!")
 
     return accelerator
 
+def add_timestep_histogram(writer, tag, edges, values, step):
+    """
+    Plot per-bucket values over t (bucket upper edges) as a TensorBoard histogram.
+    """
+    lower = [0.0] + edges[:-1]
+    centers = [(lo + hi) / 2 for lo, hi in zip(lower, edges)]
+    writer.add_histogram_raw(
+        tag,
+        min=0.0,
+        max=edges[-1],
+        num=sum(values),
+        sum=sum(c * v for c, v in zip(centers, values)),
+        sum_squares=sum(c * c * v for c, v in zip(centers, values)),
+        bucket_limits=edges,
+        bucket_counts=values,
+        global_step=step,
+    )
+
 def load_weights_with_shape_check(model, checkpoint, rank=0):
     
     model_state_dict = model.state_dict()
@@ -301,20 +515,6 @@ def load_weights_with_shape_check(model, checkpoint, rank=0):
     
     return model
 
-@torch.no_grad()
-def update_ema(ema_model, model, decay=0.9999):
-    """
-    Step the EMA model towards the current model.
-    """
-    ema_params = OrderedDict(ema_model.named_parameters())
-    model_params = OrderedDict(model.named_parameters())
-
-    for name, param in model_params.items():
-        name = name.replace("module.", "")
-        # TODO: Consider applying only to params that require_grad to avoid small numerical changes of pos_embed
-        ema_params[name].mul_(decay).add_(param.data, alpha=1 - decay)
-
-
 def requires_grad(model, flag=True):
     """
     Set requires_grad flag for all parameters in a model.
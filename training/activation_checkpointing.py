@@ -0,0 +1,117 @@
+"""
+Budget-driven activation checkpointing plan for FlashDiT.
+"""
+
+import itertools
+
+import torch
+
+from training.micro_batch import profile_training_step, reserved_bytes
+
+
+def plan_activation_checkpointing(model, transport, batch_size, input_shape, num_classes, device, autocast, memory_budget):
+    """
+    Cheapest per-block checkpoint plan whose training step fits into `memory_budget` bytes.
+
+    One training step is profiled without checkpointing and with every block set to 'attn', 'mlp' and 'full'.
+    This gives the memory saved and the recompute time added per block and mode. Blocks are identical,
+    so the plan is the count of blocks per mode that saves enough memory at the lowest added time;
+    modes are spread evenly over depth. The chosen plan is applied to the model and returned,
+    None (and the model's plan unchanged) if not even full checkpointing fits.
+
+    Args:
+        model: unwrapped FlashDiT
+        memory_budget: bytes available for the training step, including optimizer state and DDP buckets
+        others: see training.micro_batch.find_micro_batch_size
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return model.checkpoint_plan
+
+    depth = model.depth
+    budget = memory_budget - reserved_bytes(model)
+    previous_plan = list(model.checkpoint_plan)
+    was_training = model.training
+    model.train()
+
+    profiles = {}
+    for mode in ('none', 'attn', 'mlp', 'full'):
+        model.set_checkpoint_policy(mode)
+        profiles[mode] = profile_training_step(model, transport, batch_size, input_shape, num_classes, device, autocast)
+    model.train(was_training)
+
+    peak_none, time_none = profiles['none']
+    if peak_none is not None and peak_none <= budget:
+        model.set_checkpoint_policy('none')
+        return model.checkpoint_plan
+    # uniform plans that were measured to fit, cheapest first
+    fitting = sorted((seconds, mode) for mode, (peak, seconds) in profiles.items() if peak is not None and peak <= budget)
+    if len(fitting) == 0:
+        model.set_checkpoint_plan(previous_plan)
+        return None
+    if peak_none is None:
+        # without a reference step the per-block savings are unknown, use the cheapest uniform plan
+        model.set_checkpoint_policy(fitting[0][1])
+        return model.checkpoint_plan
+
+    savings, costs = {}, {}
+    for mode in ('attn', 'mlp', 'full'):
+        peak, seconds = profiles[mode]
+        if peak is None:
+            continue
+        savings[mode] = (peak_none - peak) / depth
+        costs[mode] = max(seconds - time_none, 0.0) / depth
+
+    need = peak_none - budget
+    best = None
+    modes = list(savings)
+    for counts in itertools.product(range(depth + 1), repeat=len(modes)):
+        if sum(counts) > depth:
+            continue
+        saved = sum(n * savings[m] for n, m in zip(counts, modes))
+        cost = sum(n * costs[m] for n, m in zip(counts, modes))
+        if saved >= need and (best is None or cost < best[0]):
+            best = (cost, counts)
+    if best is None:
+        model.set_checkpoint_policy(fitting[0][1])
+        return model.checkpoint_plan
+
+    # spread each mode evenly over the blocks
+    plan = ['none'] * depth
+    free = list(range(depth))
+    for mode, count in sorted(zip(modes, best[1]), key=lambda mc: -mc[1]):
+        if count == 0:
+            continue
+        chosen = [free[int(i * len(free) / count)] for i in range(count)]
+        for idx in chosen:
+            plan[idx] = mode
+        free = [idx for idx in free if idx not in chosen]
+
+    # the per-block model is an estimate, verify it and fall back to the cheapest uniform plan
+    model.set_checkpoint_plan(plan)
+    model.train()
+    peak, _ = profile_training_step(model, transport, batch_size, input_shape, num_classes, device, autocast)
+    model.train(was_training)
+    if peak is None or peak > budget:
+        model.set_checkpoint_policy(fitting[0][1])
+    return model.checkpoint_plan
+
+
+def plan_micro_batch_and_checkpointing(model, transport, batch_size, input_shape, num_classes, device, autocast, memory_budget):
+    """
+    Largest divisor of `batch_size` as micro-batch that fits into `memory_budget` with some checkpoint plan,
+    together with the cheapest plan for it (see plan_activation_checkpointing). Probing the micro-batch
+    under the planned checkpointing, instead of without checkpointing, lets larger micro-batches trade
+    partial recompute for fewer accumulation steps.
+    Returns:
+        (micro_batch_size, plan), the plan is applied to the model
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return batch_size, model.checkpoint_plan
+
+    for candidate in sorted((d for d in range(1, batch_size + 1) if batch_size % d == 0), reverse=True):
+        plan = plan_activation_checkpointing(model, transport, candidate, input_shape, num_classes, device, autocast, memory_budget)
+        if plan is not None:
+            return candidate, plan
+    raise RuntimeError(f"a micro-batch of 1 does not fit into the budget of {memory_budget} bytes even with full checkpointing")
@@ -0,0 +1,246 @@
+"""
+Asynchronous, sharded training checkpoints.
+
+Layout of one checkpoint:
+    {checkpoint_dir}/{step:07d}/
+        model.safetensors       model weights (rank 0)
+        ema.safetensors         EMA weights (rank 0), loadable alone via mmap for inference
+        optim_rank{r:02d}.pt    optimizer state of the parameters owned by rank r (param index % world_size == r)
+        meta.json               step, world size and config (rank 0)
+        done_rank{r:02d}        written by every rank after its files are complete
+
+Legacy checkpoints {checkpoint_dir}/{step:07d}.pt (one torch.save dict with model, ema and opt) are still resumed from.
+"""
+
+import os
+import json
+import random
+import threading
+from glob import glob
+
+import numpy as np
+import torch
+from safetensors.torch import save_file, load_file
+
+
+def checkpoint_path(checkpoint_dir, step):
+    return os.path.join(checkpoint_dir, f"{step:07d}")
+
+
+def is_complete(path):
+    """
+    A checkpoint is complete once every rank that wrote it left its done marker.
+    """
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r') as f:
+        world_size = json.load(f)['world_size']
+    return all(os.path.exists(os.path.join(path, f'done_rank{r:02d}')) for r in range(world_size))
+
+
+def find_latest_checkpoint(checkpoint_dir):
+    """
+    Path of the complete checkpoint with the highest step, or None.
+    Checkpoint directories are named by step, incomplete ones (e.g. preempted during writing) are skipped.
+    """
+    checkpoints = [d for d in glob(os.path.join(checkpoint_dir, '*')) if os.path.basename(d).isdigit() and is_complete(d)]
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=lambda d: int(os.path.basename(d)))
+
+
+def legacy_checkpoint_step(path):
+    """Step of a legacy {step:07d}.pt checkpoint, None for other files."""
+    name = os.path.basename(path)
+    return int(name[:-3]) if name.endswith('.pt') and name[:-3].isdigit() else None
+
+
+def find_latest_legacy_checkpoint(checkpoint_dir):
+    """
+    Path of the legacy .pt checkpoint with the highest step, or None.
+    """
+    checkpoints = [f for f in glob(os.path.join(checkpoint_dir, '*.pt')) if legacy_checkpoint_step(f) is not None]
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=legacy_checkpoint_step)
+
+
+def find_resume_checkpoint(checkpoint_dir):
+    """
+    The checkpoint to resume from: the complete checkpoint directory or legacy .pt file with the highest step, or None.
+    """
+    latest = find_latest_checkpoint(checkpoint_dir)
+    legacy = find_latest_legacy_checkpoint(checkpoint_dir)
+    if legacy is not None and (latest is None or legacy_checkpoint_step(legacy) > int(os.path.basename(latest))):
+        return legacy
+    return latest
+
+
+def get_rng_state():
+    """RNG states of python, numpy, torch and the current CUDA device."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+def shard_optimizer_state(opt_state, rank, world_size):
+    """
+    Keep only the per-parameter state owned by this rank, param_groups are kept on every rank.
+    """
+    state = {idx: s for idx, s in opt_state['state'].items() if idx % world_size == rank}
+    return {'state': state, 'param_groups': opt_state['param_groups']}
+
+
+def load_optimizer_state(path):
+    """
+    Merge the optimizer shards of all ranks back into one optimizer state dict.
+    """
+    opt_state = None
+    for shard_file in sorted(glob(os.path.join(path, 'optim_rank*.pt'))):
+        shard = torch.load(shard_file, map_location='cpu')
+        if opt_state is None:
+            opt_state = {'state': {}, 'param_groups': shard['param_groups']}
+        opt_state['state'].update(shard['state'])
+    return opt_state
+
+
+def load_training_state(path, rank, world_size):
+    """
+    Everything needed to resume from a checkpoint directory: model, EMA and merged optimizer state,
+    the step and this rank's extra state (None if the checkpoint was written with another world size).
+    Legacy .pt checkpoints have no extra state, and no optimizer state (None) if it was not saved.
+    """
+    if not os.path.isdir(path):
+        checkpoint = torch.load(path, map_location='cpu')
+        strip = lambda state: {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()}
+        return {
+            'model': strip(checkpoint['model']),
+            'ema': strip(checkpoint['ema']),
+            'opt': checkpoint['opt'] if 'opt' in checkpoint else None,
+            'step': legacy_checkpoint_step(path),
+            'extra': None,
+        }
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    extra_state = None
+    if meta['world_size'] == world_size:
+        extra_state = torch.load(os.path.join(path, f'optim_rank{rank:02d}.pt'), map_location='cpu')['extra']
+    return {
+        'model': load_model_weights(path, 'model'),
+        'ema': load_model_weights(path, 'ema'),
+        'opt': load_optimizer_state(path),
+        'step': meta['step'],
+        'extra': extra_state,
+    }
+
+
+def load_model_weights(ckpt_path, key='ema'):
+    """
+    Load model or EMA weights from a checkpoint directory (only {key}.safetensors is read, no optimizer state)
+    or from a legacy torch.save checkpoint.
+    """
+    if os.path.isdir(ckpt_path):
+        return load_file(os.path.join(ckpt_path, f'{key}.safetensors'))
+    if ckpt_path.endswith('.safetensors'):
+        return load_file(ckpt_path)
+    checkpoint = torch.load(ckpt_path, map_location=lambda storage, loc: storage)
+    if key in checkpoint:  # supports checkpoints from train.py
+        checkpoint = checkpoint[key]
+    return checkpoint
+
+
+class AsyncCheckpointer:
+    """
+    Snapshot training state into pinned CPU buffers and write it in a background thread.
+
+    The device-to-host copies are queued on the current stream, so the next optimizer step is ordered
+    after them and training continues right away; the writer thread waits on an event before reading.
+    Buffers are reused across checkpoints, at most one checkpoint is in flight.
+    """
+    def __init__(self, checkpoint_dir, rank, world_size):
+        self.checkpoint_dir = checkpoint_dir
+        self.rank = rank
+        self.world_size = world_size
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, prefix, obj):
+        """Copy all tensors of a (nested) state dict into pinned CPU buffers."""
+        if isinstance(obj, torch.Tensor):
+            buffer = self._buffers.get(prefix)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, device='cpu', pin_memory=torch.cuda.is_available())
+                self._buffers[prefix] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self._snapshot(f'{prefix}.{k}', v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(f'{prefix}.{i}', v) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, step, model_state, ema_state, opt_state, config, extra_state=None):
+        """
+        Start writing a checkpoint, returns once the snapshot is queued.
+        Rank 0 writes model, EMA and meta, every rank writes its optimizer shard and extra_state.
+        """
+        self.wait()
+        snapshot = {
+            'optim': self._snapshot('optim', shard_optimizer_state(opt_state, self.rank, self.world_size)),
+            'extra': extra_state,
+        }
+        if self.rank == 0:
+            snapshot['model'] = self._snapshot('model', model_state)
+            snapshot['ema'] = self._snapshot('ema', ema_state)
+        ready = None
+        if torch.cuda.is_available():
+            ready = torch.cuda.Event()
+            ready.record()
+
+        path = checkpoint_path(self.checkpoint_dir, step)
+        self._thread = threading.Thread(target=self._write, args=(path, step, snapshot, config, ready), daemon=True)
+        self._thread.start()
+        return path
+
+    def _write(self, path, step, snapshot, config, ready):
+        try:
+            if ready is not None:
+                ready.synchronize()
+            os.makedirs(path, exist_ok=True)
+            if self.rank == 0:
+                save_file(snapshot['model'], os.path.join(path, 'model.safetensors'))
+                save_file(snapshot['ema'], os.path.join(path, 'ema.safetensors'))
+                with open(os.path.join(path, 'meta.json'), 'w') as f:
+                    json.dump({'step': step, 'world_size': self.world_size, 'config': config}, f, indent=4)
+            torch.save({'param_groups': snapshot['optim']['param_groups'], 'state': snapshot['optim']['state'], 'extra': snapshot['extra']},
+                       os.path.join(path, f'optim_rank{self.rank:02d}.pt'))
+            with open(os.path.join(path, f'done_rank{self.rank:02d}'), 'w') as f:
+                f.write(str(step))
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """
+        Block until the checkpoint in flight is written.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Asynchronous checkpoint failed') from error
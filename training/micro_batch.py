@@ -0,0 +1,92 @@
+"""
+Micro-batch size selection for gradient accumulation.
+"""
+
+import copy
+from time import perf_counter
+
+import torch
+
+
+def profile_training_step(model, transport, batch_size, input_shape, num_classes, device, autocast):
+    """
+    Peak memory (bytes) and time (seconds) of one training forward + backward of the unwrapped model
+    on random latents, (None, None) on out-of-memory. Gradients are cleared afterwards.
+    The timestep distribution (e.g. the adaptive loss estimate), the timestep generator and the global RNG
+    are restored, so that probing does not change the training run.
+    """
+    timestep_dist = copy.deepcopy(transport.timestep_dist)
+    generator = transport.get_generator(torch.device(device))
+    generator_state = generator.get_state() if generator is not None else None
+    with torch.random.fork_rng(devices=[device]):
+        peak, seconds = _profile_training_step(model, transport, batch_size, input_shape, num_classes, device, autocast)
+    transport.timestep_dist = timestep_dist
+    if generator is not None:
+        generator.set_state(generator_state)
+    return peak, seconds
+
+
+def _profile_training_step(model, transport, batch_size, input_shape, num_classes, device, autocast):
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    torch.cuda.synchronize(device)
+    start = perf_counter()
+    try:
+        x = torch.randn(batch_size, *input_shape, device=device)
+        y = torch.randint(0, num_classes, (batch_size,), device=device)
+        with autocast():
+            loss_dict = transport.training_losses(model, x, dict(y=y))
+        loss = loss_dict['loss'].mean()
+        if 'cos_loss' in loss_dict:
+            loss = loss + loss_dict['cos_loss'].mean()
+        loss.backward()
+        torch.cuda.synchronize(device)
+        peak, seconds = torch.cuda.max_memory_allocated(device), perf_counter() - start
+    except torch.cuda.OutOfMemoryError:
+        peak, seconds = None, None
+    # drop references to activations and grads before the next profile
+    x = y = loss_dict = loss = None
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return peak, seconds
+
+
+def reserved_bytes(model):
+    """
+    Memory that only appears at the first real step and is not seen by profile_training_step:
+    the two AdamW moments and the DDP gradient buckets, i.e. three fp32 copies of the trainable parameters.
+    """
+    return 3 * sum(p.numel() * 4 for p in model.parameters() if p.requires_grad)
+
+
+def find_micro_batch_size(model, transport, batch_size, input_shape, num_classes, device, autocast, memory_fraction=0.9):
+    """
+    Largest divisor of `batch_size` whose training forward + backward fits into `memory_fraction` of device memory.
+
+    The probe runs on the unwrapped model (no DDP collectives, so ranks may probe independently and
+    agree on the minimum afterwards), with the model's current activation checkpointing plan.
+
+    Args:
+        model: unwrapped model
+        transport: Transport, provides the training loss
+        batch_size: samples per device and optimizer step
+        input_shape: (C, H, W) of one latent
+        num_classes: number of class labels
+        device: cuda device to probe on, on other devices batch_size is returned
+        autocast: context manager factory of the mixed precision setting, e.g. accelerator.autocast
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return batch_size
+
+    budget = memory_fraction * torch.cuda.get_device_properties(device).total_memory - reserved_bytes(model)
+    was_training = model.training
+    model.train()
+    micro_batch_size = 1
+    for candidate in sorted((d for d in range(1, batch_size + 1) if batch_size % d == 0), reverse=True):
+        peak, _ = profile_training_step(model, transport, candidate, input_shape, num_classes, device, autocast)
+        if peak is not None and peak < budget:
+            micro_batch_size = candidate
+            break
+    model.train(was_training)
+    return micro_batch_size
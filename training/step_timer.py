@@ -0,0 +1,63 @@
+"""
+Step time breakdown of the training loop.
+"""
+
+from time import perf_counter
+from contextlib import contextmanager
+from collections import defaultdict
+
+import torch
+
+
+class StepTimer:
+    """
+    Per-phase time breakdown (data wait, forward, backward, optimizer, EMA, checkpoint) without
+    host-device syncs in the hot loop. Device phases are timed with CUDA events that are only read back
+    in summary(), which is called at log time right after the loop already synchronized.
+    Host phases (data wait, checkpoint) and all phases on CPU use perf_counter.
+    """
+    def __init__(self, device):
+        self.use_events = torch.device(device).type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self._events = defaultdict(list)
+        self._host = defaultdict(float)
+        self._steps = 0
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of device work."""
+        if self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events[name].append((start, end))
+        else:
+            start = perf_counter()
+            yield
+            self._host[name] += perf_counter() - start
+
+    @contextmanager
+    def host_phase(self, name):
+        """Time a phase that blocks the host, e.g. waiting for data."""
+        start = perf_counter()
+        yield
+        self._host[name] += perf_counter() - start
+
+    def step(self):
+        self._steps += 1
+
+    def summary(self):
+        """
+        Average milliseconds per step of every phase since the last summary, then reset.
+        The caller has to synchronize the device before, so that all events completed.
+        """
+        steps = max(self._steps, 1)
+        times = {name: seconds * 1e3 / steps for name, seconds in self._host.items()}
+        for name, events in self._events.items():
+            times[name] = sum(start.elapsed_time(end) for start, end in events) / steps
+        self.reset()
+        return times
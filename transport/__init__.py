@@ -1,4 +1,6 @@
 from .transport import Transport, ModelType, WeightType, PathType, Sampler
+from .timesteps import create_timestep_distribution, PartialRange, Truncated
+from .engine import SamplingEngine, SampleRequest
 
 def create_transport(
     path_type='Linear',
@@ -10,7 +12,10 @@ def create_transport(
     use_lognorm=None,
     partitial_train=None,
     partial_ratio=1.0,
-    shift_lg=False,
+    timestep_distribution=None,
+    seed=None,
+    samples_per_latent=1,
+    fused_loss=False,
 ):
     """function for creating Transport object
     **Note**: model prediction defaults to velocity
@@ -22,6 +27,12 @@ def create_transport(
     - likelihood_weighted: weight loss by likelihood weight
     - train_eps: small epsilon for avoiding instability during training
     - sample_eps: small epsilon for avoiding instability during sampling
+    - use_lognorm: logit-normal instead of uniform timesteps, if timestep_distribution is not given
+    - partitial_train / partial_ratio: with probability partial_ratio a batch is drawn from the [low, high] range, not with the adaptive distribution
+    - timestep_distribution: dict(name=..., **kwargs) for transport.timesteps.create_timestep_distribution
+    - seed: seed of the on-device timestep generator, None uses the global RNG
+    - samples_per_latent: number of (t, noise) draws per latent in training_losses, with stratified t
+    - fused_loss: single-pass MSE + cosine objective with a recomputing backward (linear path, velocity only)
     """
 
     if prediction == "noise":
@@ -56,6 +67,15 @@ def create_transport(
         train_eps = 0
         sample_eps = 0
     
+    if timestep_distribution is None:
+        timestep_distribution = dict(name='logit_normal' if use_lognorm else 'uniform')
+    timestep_dist = create_timestep_distribution(**timestep_distribution)
+    if partitial_train is not None:
+        assert timestep_distribution['name'] != 'adaptive', \
+            "partitial_train can not be combined with the adaptive timestep distribution, " \
+            "truncate its base with low / high instead"
+        timestep_dist = PartialRange(timestep_dist, Truncated(timestep_dist, *partitial_train), partial_ratio)
+
     # create flow state
     state = Transport(
         model_type=model_type,
@@ -64,10 +84,10 @@ def create_transport(
         train_eps=train_eps,
         sample_eps=sample_eps,
         use_cosine_loss=use_cosine_loss,
-        use_lognorm=use_lognorm,
-        partitial_train=partitial_train,
-        partial_ratio=partial_ratio,
-        shift_lg=shift_lg,
+        timestep_dist=timestep_dist,
+        seed=seed,
+        samples_per_latent=samples_per_latent,
+        fused_loss=fused_loss,
     )
     
     return state
\ No newline at end of file
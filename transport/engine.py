@@ -0,0 +1,170 @@
+import torch as th
+from collections import deque
+
+from .solvers import get_timesteps
+
+
+class SampleRequest:
+    """One class-conditional generation request of the sampling engine
+    Args:
+    - label: class label
+    - seed: seed of the initial noise, the result does not depend on which requests share the batch
+    - cfg_scale: classifier-free guidance scale, <= 1 disables guidance
+    - num_steps: number of time grid points (num_steps - 1 Euler steps), as for the native ODE solvers
+    - timestep_shift: FLUX-style shift of the time grid, see get_timesteps
+    - payload: anything the caller wants back with the result
+    """
+    def __init__(self, label, seed, cfg_scale=1.0, num_steps=250, timestep_shift=0.0, payload=None):
+        assert num_steps >= 2, "a request needs at least one integration step"
+        self.label = label
+        self.seed = seed
+        self.cfg_scale = cfg_scale
+        self.num_steps = num_steps
+        self.timestep_shift = timestep_shift
+        self.payload = payload
+
+
+class SamplingEngine:
+    """Continuous-batching Euler sampler.
+    Every slot of the batch is an independent request with its own label, noise seed, cfg scale, time grid
+    and position on it. Each call of step() runs the model once on all active slots at their own t,
+    advances every slot to its next grid point, retires the slots that reached t1 and admits pending
+    requests into the freed slots, so that the model keeps running on a full batch.
+
+    Guidance only adds the null-class rows of slots that are guided at this step (cfg_scale > 1 and
+    t >= cfg_interval_start), and is applied to the first cfg_channels channels like forward_with_cfg.
+    """
+    def __init__(
+        self,
+        model,
+        sampler,
+        latent_shape,
+        *,
+        batch_size,
+        cfg_interval_start=0.0,
+        cfg_channels=3,
+        device=None,
+    ):
+        assert getattr(model, 'block_cache', None) is None, "the block cache needs a shared time grid, disable it"
+        self.model = model
+        self.drift = sampler.drift
+        self.t0, self.t1 = sampler.transport.check_interval(
+            sampler.transport.train_eps,
+            sampler.transport.sample_eps,
+            sde=False,
+            eval=True,
+            reverse=False,
+            last_step_size=0.0,
+        )
+        self.latent_shape = tuple(latent_shape)
+        self.batch_size = batch_size
+        self.cfg_interval_start = cfg_interval_start
+        self.cfg_channels = cfg_channels
+        self.device = th.device(device) if device is not None else next(model.parameters()).device
+        self.null_class = model.y_embedder.num_classes
+
+        self.pending = deque()
+        # per-slot state, the tensors are compacted on retirement so that slot i is row i
+        self.slots = []     # [request, time grid (list), index of the current grid point]
+        self.x = th.empty(0, *self.latent_shape, device=self.device)
+        self.y = th.empty(0, dtype=th.long, device=self.device)
+        self.cfg = th.empty(0, device=self.device)
+        # model rows evaluated (null-class rows included) and finished requests, for throughput reports
+        self.model_rows = 0
+        self.model_calls = 0
+        self.num_finished = 0
+
+    @property
+    def num_active(self):
+        return len(self.slots)
+
+    @property
+    def num_pending(self):
+        return len(self.pending)
+
+    def submit(self, request):
+        self.pending.append(request)
+
+    def reset(self):
+        """Drop all pending and active requests, e.g. after a failed step"""
+        self.pending.clear()
+        self.slots = []
+        self.x = th.empty(0, *self.latent_shape, device=self.device)
+        self.y = th.empty(0, dtype=th.long, device=self.device)
+        self.cfg = th.empty(0, device=self.device)
+
+    def _noise(self, seed):
+        generator = th.Generator(device=self.device)
+        generator.manual_seed(seed)
+        return th.randn(self.latent_shape, generator=generator, device=self.device)
+
+    def _admit(self):
+        new = []
+        while self.pending and len(self.slots) + len(new) < self.batch_size:
+            request = self.pending.popleft()
+            grid = get_timesteps(self.t0, self.t1, request.num_steps, request.timestep_shift).tolist()
+            new.append([request, grid, 0])
+        if not new:
+            return
+        # build the new rows first, so that a failure (e.g. an invalid seed) leaves the slots consistent
+        x = th.cat([self.x, th.stack([self._noise(slot[0].seed) for slot in new])])
+        y = th.cat([self.y, th.tensor([slot[0].label for slot in new], dtype=th.long, device=self.device)])
+        cfg = th.cat([self.cfg, th.tensor([float(slot[0].cfg_scale) for slot in new], device=self.device)])
+        self.slots += new
+        self.x, self.y, self.cfg = x, y, cfg
+
+    @th.no_grad()
+    def step(self):
+        """Admit pending requests, run one Euler step of every active slot and retire the finished ones.
+        Returns:
+        - list of (request, latent) of the requests that finished at this step
+        """
+        self._admit()
+        if not self.slots:
+            return []
+        n = len(self.slots)
+        t_cur = [grid[i] for _, grid, i in self.slots]
+        dt = th.tensor([grid[i + 1] - grid[i] for _, grid, i in self.slots], device=self.device)
+        t = th.tensor(t_cur, device=self.device)
+        guided = [k for k, (request, _, _) in enumerate(self.slots)
+                  if request.cfg_scale > 1.0 and t_cur[k] >= self.cfg_interval_start]
+
+        x_in, t_in, y_in = self.x, t, self.y
+        if guided:
+            g = th.tensor(guided, dtype=th.long, device=self.device)
+            x_in = th.cat([x_in, self.x[g]])
+            t_in = th.cat([t_in, t[g]])
+            y_in = th.cat([y_in, th.full((len(guided),), self.null_class, dtype=th.long, device=self.device)])
+        out = self.drift(x_in, t_in, self.model, y=y_in)
+        v = out[:n]
+        if guided:
+            c = self.cfg_channels
+            cond, uncond = v[g, :c], out[n:, :c]
+            v = v.clone()
+            v[g, :c] = uncond + self.cfg[g].view(-1, 1, 1, 1) * (cond - uncond)
+        self.model_rows += x_in.shape[0]
+        self.model_calls += 1
+
+        self.x = self.x + dt.view(-1, 1, 1, 1) * v
+        for slot in self.slots:
+            slot[2] += 1
+
+        # retire the slots that reached the end of their grid
+        done = [k for k, (_, grid, i) in enumerate(self.slots) if i == len(grid) - 1]
+        if not done:
+            return []
+        finished = [(self.slots[k][0], self.x[k]) for k in done]
+        done_set = set(done)
+        keep = [k for k in range(n) if k not in done_set]
+        keep_index = th.tensor(keep, dtype=th.long, device=self.device)
+        self.slots = [self.slots[k] for k in keep]
+        self.x, self.y, self.cfg = self.x[keep_index], self.y[keep_index], self.cfg[keep_index]
+        self.num_finished += len(finished)
+        return finished
+
+    def run(self, requests=()):
+        """Submit requests and step until every request is finished, yielding (request, latent) pairs"""
+        for request in requests:
+            self.submit(request)
+        while self.pending or self.slots:
+            yield from self.step()
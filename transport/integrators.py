@@ -4,6 +4,7 @@ import torch.nn as nn
 from torchdiffeq import odeint
 from functools import partial
 from tqdm import tqdm
+from .solvers import get_timesteps
 
 class sde:
     """SDE solver class"""
@@ -86,19 +87,12 @@ class ode:
         num_steps,
         atol,
         rtol,
-        timestep_shift,
+        timestep_shift=0.0,
     ):
         assert t0 < t1, "ODE sampler has to be in forward time"
 
         self.drift = drift
-        self.t = th.linspace(t0, t1, num_steps)
-
-        if timestep_shift > 0:
-            def compute_tm(t_n, timestep_shift):
-                numerator = timestep_shift * t_n
-                denominator = 1 + (timestep_shift - 1) * t_n
-                return numerator / denominator
-            self.t = th.tensor([compute_tm(t_n, timestep_shift) for t_n in self.t])
+        self.t = get_timesteps(t0, t1, num_steps, timestep_shift)
 
         self.atol = atol
         self.rtol = rtol
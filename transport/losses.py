@@ -0,0 +1,84 @@
+import torch as th
+
+
+#################### Fused Velocity Objective ####################
+
+def linear_xt(t, x0, x1):
+    """xt of the linear path (ICPlan), t * x1 + (1 - t) * x0, without materializing ut"""
+    t = t.view(-1, *([1] * (x1.dim() - 1)))
+    return th.lerp(x0, x1, t)
+
+
+def _velocity_losses(v, x0, x1, mask, eps):
+    """
+    Per-sample MSE and (1 - cosine) of the model velocity v against ut = x1 - x0 of the linear path,
+    cosine over channels (dim 1). mask: (B, 1, H, W) or None, losses are averaged where it is 1.
+    Elementwise ops and reductions only, so that torch.compile can fuse them into one pass.
+    """
+    diff = v - (x1 - x0)
+    sq = diff.square().sum(dim=1, keepdim=True)                   # B 1 H W
+    dot = (v * (x1 - x0)).sum(dim=1, keepdim=True)
+    v_sq = v.square().sum(dim=1, keepdim=True)
+    u_sq = (x1 - x0).square().sum(dim=1, keepdim=True)
+    denom = (v_sq * u_sq).clamp_min(eps * eps).sqrt()
+    cos = dot / denom
+    if mask is None:
+        count = sq[0].numel()
+        mse = sq.flatten(1).sum(dim=1) / (count * v.shape[1])
+        cos_loss = (1 - cos).flatten(1).sum(dim=1) / count
+    else:
+        count = mask.flatten(1).sum(dim=1).clamp(min=1)
+        mse = (sq * mask).flatten(1).sum(dim=1) / (count * v.shape[1])
+        cos_loss = ((1 - cos) * mask).flatten(1).sum(dim=1) / count
+    return mse, cos_loss
+
+
+def _velocity_losses_backward(v, x0, x1, mask, eps, grad_mse, grad_cos):
+    """Gradient of _velocity_losses w.r.t. v, recomputing ut from x0 and x1."""
+    u = x1 - x0
+    dot = (v * u).sum(dim=1, keepdim=True)
+    v_sq = v.square().sum(dim=1, keepdim=True)
+    u_sq = u.square().sum(dim=1, keepdim=True)
+    prod = v_sq * u_sq
+    denom = prod.clamp_min(eps * eps).sqrt()
+    cos = dot / denom
+    # d cos / d v = u / denom - cos * v / |v|^2, the second term vanishes where the denominator is clamped
+    v_term = th.where(prod > eps * eps, cos / v_sq.clamp_min(eps * eps), th.zeros_like(cos))
+
+    shape = (-1,) + (1,) * (v.dim() - 1)
+    if mask is None:
+        count = float(v[0, 0].numel())
+        w_mse = (2 * grad_mse / (count * v.shape[1])).view(shape)
+        w_cos = (grad_cos / count).view(shape)
+    else:
+        count = mask.flatten(1).sum(dim=1).clamp(min=1)
+        w_mse = (2 * grad_mse / (count * v.shape[1])).view(shape) * mask
+        w_cos = (grad_cos / count).view(shape) * mask
+    return w_mse * (v - u) - w_cos * (u / denom - v_term * v)
+
+
+class FusedVelocityLoss(th.autograd.Function):
+    """
+    MSE + cosine velocity objective of the linear path. Only v, x0 and x1 (which are alive anyway) are saved;
+    ut, v - ut and the normalized vectors are recomputed in backward instead of being stored by autograd.
+    """
+    @staticmethod
+    def forward(ctx, v, x0, x1, mask, eps):
+        ctx.save_for_backward(v, x0, x1, mask)
+        ctx.eps = eps
+        return _velocity_losses(v, x0, x1, mask, eps)
+
+    @staticmethod
+    def backward(ctx, grad_mse, grad_cos):
+        v, x0, x1, mask = ctx.saved_tensors
+        assert not any(ctx.needs_input_grad[1:4]), "fused velocity loss only differentiates the model output"
+        grad_v = _velocity_losses_backward(v, x0, x1, mask, ctx.eps, grad_mse, grad_cos)
+        return grad_v.to(v.dtype), None, None, None, None
+
+
+def fused_velocity_losses(v, x0, x1, loss_mask=None, eps=1e-8):
+    """
+    Per-sample (mse, cos_loss) of model output v against ut = x1 - x0, equal to
+    mean_flat((v - ut) ** 2) and mean_flat(1 - cosine_similarity(v, ut, dim=1)) of the linear path.
+    """
+    return FusedVelocityLoss.apply(v, x0.detach(), x1.detach(), loss_mask, eps)
@@ -0,0 +1,313 @@
+import math
+import torch as th
+
+NATIVE_SOLVERS = ["euler", "heun", "midpoint", "dpm++2m"]
+
+
+def get_timesteps(t0, t1, num_steps, timestep_shift=0.0):
+    """Time grid of the fixed-step ODE solvers
+    Args:
+    - t0, t1: start and end time of the integration
+    - num_steps: number of grid points (num_steps - 1 integration steps)
+    - timestep_shift: FLUX-style shift t -> s * t / (1 + (s - 1) * t), disabled if <= 0
+    """
+    t = th.linspace(t0, t1, num_steps)
+    if timestep_shift > 0:
+        t = timestep_shift * t / (1 + (timestep_shift - 1) * t)
+    return t
+
+
+def _log_snr(t):
+    """log(alpha_t / sigma_t) of the linear path, alpha_t = t and sigma_t = 1 - t"""
+    if t <= 0:
+        return -math.inf
+    if t >= 1:
+        return math.inf
+    return math.log(t) - math.log(1 - t)
+
+
+class native_ode:
+    """Fixed-step ODE solvers that integrate without torchdiffeq
+    and only keep the current state in memory"""
+    def __init__(
+        self,
+        drift,
+        *,
+        t0,
+        t1,
+        sampler_type,
+        num_steps,
+        timestep_shift=0.0,
+    ):
+        assert t0 < t1, "ODE sampler has to be in forward time"
+        assert sampler_type in NATIVE_SOLVERS, f"Native solver {sampler_type} not implemented."
+
+        self.drift = drift
+        self.t = get_timesteps(t0, t1, num_steps, timestep_shift)
+        self.sampler_type = sampler_type
+
+    def _velocity(self, x, t, model, **model_kwargs):
+        t = th.ones(x.size(0), device=x.device) * t
+        return self.drift(x, t, model, **model_kwargs)
+
+    def __euler_step(self, x, t_cur, t_next, model, state, **model_kwargs):
+        v = self._velocity(x, t_cur, model, **model_kwargs)
+        return x + (t_next - t_cur) * v
+
+    def __heun_step(self, x, t_cur, t_next, model, state, **model_kwargs):
+        dt = t_next - t_cur
+        v_cur = self._velocity(x, t_cur, model, **model_kwargs)
+        x_pred = x + dt * v_cur
+        v_next = self._velocity(x_pred, t_next, model, **model_kwargs)
+        return x + 0.5 * dt * (v_cur + v_next)
+
+    def __midpoint_step(self, x, t_cur, t_next, model, state, **model_kwargs):
+        dt = t_next - t_cur
+        v_cur = self._velocity(x, t_cur, model, **model_kwargs)
+        x_mid = x + 0.5 * dt * v_cur
+        v_mid = self._velocity(x_mid, t_cur + 0.5 * dt, model, **model_kwargs)
+        return x + dt * v_mid
+
+    def __dpm_solver_2m_step(self, x, t_cur, t_next, model, state, **model_kwargs):
+        """DPM-Solver++(2M) in data prediction, adapted to the velocity of the linear path:
+        x_t = t * x1 + (1 - t) * x0, so the data prediction is x1 = x_t + (1 - t) * v"""
+        v = self._velocity(x, t_cur, model, **model_kwargs)
+        x1_pred = x + (1 - t_cur) * v
+
+        h = _log_snr(t_next) - _log_snr(t_cur)
+        h_prev = state.get('h_prev')
+        if h_prev is None or not math.isfinite(h_prev) or not math.isfinite(h):
+            # first step from pure noise and last step onto the data are taken with first order
+            d = x1_pred
+        else:
+            r = h_prev / h
+            d = (1 + 1 / (2 * r)) * x1_pred - 1 / (2 * r) * state['x1_pred_prev']
+        state['h_prev'] = h
+        state['x1_pred_prev'] = x1_pred
+
+        # exact exponential integrator: sigma_t / sigma_s * x + (alpha_t - alpha_s * sigma_t / sigma_s) * d
+        ratio = (1 - t_next) / (1 - t_cur)
+        return ratio * x + (t_next - t_cur * ratio) * d
+
+    def __forward_fn(self):
+        sampler_dict = {
+            "euler": self.__euler_step,
+            "heun": self.__heun_step,
+            "midpoint": self.__midpoint_step,
+            "dpm++2m": self.__dpm_solver_2m_step,
+        }
+        return sampler_dict[self.sampler_type]
+
+    def sample(self, x, model, callback=None, return_all=False, **model_kwargs):
+        """forward loop of the fixed-step ODE solver
+        Args:
+        - x: initial noise
+        - model: backbone model
+        - callback: optional fn(step, t, x) called after every step
+        - return_all: also keep the intermediate states
+        Returns:
+        - list of states, only the final one unless return_all is set
+        """
+        sampler = self.__forward_fn()
+        ts = self.t.tolist()
+        state = {}
+        samples = [x] if return_all else []
+        with th.no_grad():
+            for i, (t_cur, t_next) in enumerate(zip(ts[:-1], ts[1:])):
+                x = sampler(x, t_cur, t_next, model, state, **model_kwargs)
+                if return_all:
+                    samples.append(x)
+                if callback is not None:
+                    callback(i, t_next, x)
+        if not return_all:
+            samples.append(x)
+        return samples
+
+
+# embedded Runge-Kutta pairs of the per-sample adaptive solver:
+# (c, a, b, b_err = b - b_hat, order of the error estimate + 1, first same as last)
+ADAPTIVE_TABLEAUS = {
+    "heun_euler": (
+        [0.0, 1.0],
+        [[], [1.0]],
+        [1 / 2, 1 / 2],
+        [-1 / 2, 1 / 2],
+        2, False,
+    ),
+    "bosh3": (
+        [0.0, 1 / 2, 3 / 4, 1.0],
+        [[], [1 / 2], [0.0, 3 / 4], [2 / 9, 1 / 3, 4 / 9]],
+        [2 / 9, 1 / 3, 4 / 9, 0.0],
+        [2 / 9 - 7 / 24, 1 / 3 - 1 / 4, 4 / 9 - 1 / 3, -1 / 8],
+        3, True,
+    ),
+    "dopri5": (
+        [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0],
+        [
+            [],
+            [1 / 5],
+            [3 / 40, 9 / 40],
+            [44 / 45, -56 / 15, 32 / 9],
+            [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+            [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+            [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+        ],
+        [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0],
+        [35 / 384 - 5179 / 57600, 0.0, 500 / 1113 - 7571 / 16695, 125 / 192 - 393 / 640,
+         -2187 / 6784 + 92097 / 339200, 11 / 84 - 187 / 2100, -1 / 40],
+        5, True,
+    ),
+}
+ADAPTIVE_SOLVERS = list(ADAPTIVE_TABLEAUS)
+
+
+def nfe_summary(nfe):
+    """Statistics of per-sample numbers of function evaluations, for logging"""
+    nfe = th.as_tensor(nfe).float()
+    return {
+        'nfe_mean': nfe.mean().item(),
+        'nfe_min': nfe.min().item(),
+        'nfe_p50': nfe.quantile(0.5).item(),
+        'nfe_p90': nfe.quantile(0.9).item(),
+        'nfe_max': nfe.max().item(),
+    }
+
+
+class adaptive_ode:
+    """Embedded Runge-Kutta solver with a step size controller per sample.
+    Every sample of the batch keeps its own t, step size and error estimate, so easy samples take
+    fewer steps than hard ones. Samples that reach t1 are compacted out of the batch and replaced by
+    new ones (see stream), so that the model keeps running on a full batch."""
+    def __init__(
+        self,
+        drift,
+        *,
+        t0,
+        t1,
+        sampler_type,
+        atol,
+        rtol,
+        first_step,
+        safety=0.9,
+        min_factor=0.2,
+        max_factor=10.0,
+        min_step=1e-4,
+    ):
+        assert t0 < t1, "ODE sampler has to be in forward time"
+        assert sampler_type in ADAPTIVE_SOLVERS, f"Adaptive solver {sampler_type} not implemented."
+
+        self.drift = drift
+        self.t0, self.t1 = t0, t1
+        self.tableau = ADAPTIVE_TABLEAUS[sampler_type]
+        self.atol = atol
+        self.rtol = rtol
+        self.first_step = first_step
+        self.safety = safety
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        # steps at or below min_step are accepted regardless of the error, which guarantees termination
+        self.min_step = min_step
+        self.nfe = None
+
+    @th.no_grad()
+    def _velocity(self, x, t, model, per_sample_kwargs, model_kwargs):
+        return self.drift(x, t, model, **per_sample_kwargs, **model_kwargs)
+
+    def _step(self, x, t, h, k1, model, per_sample_kwargs, model_kwargs):
+        """One attempted step of every sample, returns (x_new, err_norm, k_last, number of evaluations)"""
+        c, a, b, b_err, _, fsal = self.tableau
+        h_x = h.view(-1, *([1] * (x.dim() - 1)))
+        evals = len(c) if k1 is None else len(c) - 1
+        if k1 is None:
+            k1 = self._velocity(x, t, model, per_sample_kwargs, model_kwargs)
+        ks = [k1]
+        for i in range(1, len(c)):
+            xi = x + h_x * sum(a_ij * k for a_ij, k in zip(a[i], ks) if a_ij != 0)
+            ks.append(self._velocity(xi, t + c[i] * h, model, per_sample_kwargs, model_kwargs))
+        # for first-same-as-last pairs the last stage is evaluated at the solution itself
+        x_new = xi if fsal else x + h_x * sum(b_i * k for b_i, k in zip(b, ks) if b_i != 0)
+        err = h_x * sum(e_i * k for e_i, k in zip(b_err, ks) if e_i != 0)
+        scale = self.atol + self.rtol * th.maximum(x.abs(), x_new.abs())
+        err_norm = (err / scale).square().flatten(1).mean(dim=1).sqrt()
+        return x_new, err_norm, ks[-1], evals
+
+    def stream(self, init_fn, num_samples, batch_size, model, **model_kwargs):
+        """Integrate num_samples samples with at most batch_size in flight
+        Args:
+        - init_fn: fn(start, n) -> (x, per_sample_kwargs) with the initial noise of samples
+          start, ..., start + n - 1 and a dict of their per-sample model inputs (e.g. labels)
+        - model: backbone model
+        - model_kwargs: model inputs shared by all samples
+        Yields:
+        - (ids, x, nfe) of the samples that reached t1 at this step, ids give the order of admission
+        """
+        _, _, _, _, order, fsal = self.tableau
+        admitted = 0
+        x = None
+        while True:
+            # refill the batch with new samples
+            active = 0 if x is None else x.shape[0]
+            n_new = min(batch_size - active, num_samples - admitted)
+            if n_new > 0:
+                x_new, kw_new = init_fn(admitted, n_new)
+                device = x_new.device
+                t_new = th.full((n_new,), self.t0, device=device)
+                h_new = th.full((n_new,), self.first_step, device=device)
+                nfe_new = th.zeros(n_new, dtype=th.long, device=device)
+                ids_new = th.arange(admitted, admitted + n_new, device=device)
+                if fsal:
+                    k1_new = self._velocity(x_new, t_new, model, kw_new, model_kwargs)
+                    nfe_new += 1
+                if x is None:
+                    x, t, h, nfe, ids, kw = x_new, t_new, h_new, nfe_new, ids_new, kw_new
+                    k1 = k1_new if fsal else None
+                else:
+                    x, t, h = th.cat([x, x_new]), th.cat([t, t_new]), th.cat([h, h_new])
+                    nfe, ids = th.cat([nfe, nfe_new]), th.cat([ids, ids_new])
+                    kw = {key: th.cat([value, kw_new[key]]) for key, value in kw.items()}
+                    k1 = th.cat([k1, k1_new]) if fsal else None
+                admitted += n_new
+            if x is None or x.shape[0] == 0:
+                return
+
+            # one attempted step of every active sample, clipped to the end of the interval
+            last = t + h >= self.t1
+            h = th.where(last, self.t1 - t, h)
+            x_new, err_norm, k_last, evals = self._step(x, t, h, k1, model, kw, model_kwargs)
+            nfe += evals
+            accept = (err_norm <= 1) | (h <= self.min_step)
+            x = th.where(accept.view(-1, *([1] * (x.dim() - 1))), x_new, x)
+            t = th.where(accept, th.where(last, th.full_like(t, self.t1), t + h), t)
+            if fsal:
+                k1 = th.where(accept.view(-1, *([1] * (x.dim() - 1))), k_last, k1)
+            factor = (self.safety * err_norm.clamp(min=1e-10) ** (-1.0 / order)).clamp(self.min_factor, self.max_factor)
+            factor = th.where(accept, factor, factor.clamp(max=1.0))
+            h = (h * factor).clamp(min=self.min_step)
+
+            # compact finished samples out of the batch
+            done = accept & last
+            if done.any():
+                yield ids[done], x[done], nfe[done]
+                keep = ~done
+                x, t, h, nfe, ids = x[keep], t[keep], h[keep], nfe[keep], ids[keep]
+                kw = {key: value[keep] for key, value in kw.items()}
+                if fsal:
+                    k1 = k1[keep]
+
+    def sample(self, x, model, **model_kwargs):
+        """Integrate a fixed batch, finished samples are dropped from the batch but not refilled.
+        Tensors in model_kwargs with the batch size as leading dimension are treated as per-sample inputs.
+        The per-sample NFE of the last call is kept in self.nfe.
+        Returns:
+        - list with the final state
+        """
+        n = x.shape[0]
+        per_sample = {k: v for k, v in model_kwargs.items() if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == n}
+        shared = {k: v for k, v in model_kwargs.items() if k not in per_sample}
+        init_fn = lambda start, count: (x[start:start + count], {k: v[start:start + count] for k, v in per_sample.items()})
+        out = th.empty_like(x)
+        self.nfe = th.zeros(n, dtype=th.long, device=x.device)
+        for ids, x_done, nfe in self.stream(init_fn, n, n, model, **shared):
+            out[ids] = x_done
+            self.nfe[ids] = nfe
+        return [out]
@@ -0,0 +1,281 @@
+import math
+import torch as th
+import torch.distributed as dist
+
+
+#################### Timestep Distributions ####################
+
+class TimestepDistribution:
+    """
+    Distribution of training timesteps on [0, 1], sampled on the data's device by inverse CDF.
+    `icdf` maps u ~ U[0, 1) to t, which also gives stratified sampling for free.
+    Adaptive distributions additionally learn from the per-sample losses (update / sync) and
+    return importance weights that keep the loss unbiased.
+    """
+    sync_every = 0
+
+    def weights(self, t):
+        """Per-sample loss weights, None for no reweighting."""
+        return None
+
+    def update(self, t, losses):
+        pass
+
+    def sync(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+    def icdf(self, u):
+        raise NotImplementedError()
+
+    def cdf(self, t):
+        raise NotImplementedError()
+
+    def sample(self, n, device=None, generator=None):
+        u = th.rand((n,), device=device, generator=generator)
+        return self.icdf(u)
+
+    def sample_stratified(self, n, k, device=None, generator=None):
+        """n samples in groups of k consecutive samples, each of the k covers its own stratum [i / k, (i + 1) / k)."""
+        u = (th.arange(k, device=device).repeat(n // k) + th.rand((n,), device=device, generator=generator)) / k
+        return self.icdf(u)
+
+
+class Uniform(TimestepDistribution):
+    """Uniform on [low, high]"""
+    def __init__(self, low=0.0, high=1.0):
+        self.low = low
+        self.high = high
+
+    def icdf(self, u):
+        return self.low + u * (self.high - self.low)
+
+    def cdf(self, t):
+        return ((t - self.low) / (self.high - self.low)).clamp(0, 1)
+
+
+class LogitNormal(TimestepDistribution):
+    """
+    t = sigmoid(z), z ~ N(mu, sigma) (SD3 / FasterDiT lognorm sampling).
+    mu != 0 gives the shifted logit-normal.
+    """
+    def __init__(self, mu=0.0, sigma=1.0):
+        self.mu = mu
+        self.sigma = sigma
+
+    def icdf(self, u):
+        return th.sigmoid(self.mu + self.sigma * th.special.ndtri(u))
+
+    def cdf(self, t):
+        return th.special.ndtr((th.logit(t) - self.mu) / self.sigma)
+
+
+class ModeSampling(TimestepDistribution):
+    """
+    Mode sampling with heavy tails from SD3, scale in [-1, 2 / (pi - 2)].
+    scale > 0 puts more mass on the middle of the trajectory, 0 is uniform.
+    Written for t = 1 at data (this repo's convention), the SD3 formula is mirrored.
+    """
+    def __init__(self, scale=1.29):
+        assert -1 <= scale <= 2 / (math.pi - 2), f"mode sampling scale {scale} is outside [-1, 2 / (pi - 2)]"
+        self.scale = scale
+
+    def icdf(self, u):
+        return u + self.scale * (th.cos(math.pi / 2 * u) ** 2 - 1 + u)
+
+    def cdf(self, t):
+        # no closed form, invert the monotone icdf by bisection
+        low, high = th.zeros_like(t), th.ones_like(t)
+        for _ in range(40):
+            mid = (low + high) / 2
+            below = self.icdf(mid) < t
+            low = th.where(below, mid, low)
+            high = th.where(below, high, mid)
+        return (low + high) / 2
+
+
+class Truncated(TimestepDistribution):
+    """
+    `base` restricted to [low, high], sampled by inverse CDF within [cdf(low), cdf(high)] instead of rejection.
+    """
+    def __init__(self, base, low, high):
+        self.base = base
+        self.low = low
+        self.high = high
+        bounds = base.cdf(th.tensor([low, high], dtype=th.float64))
+        self.u_low, self.u_high = bounds[0].item(), bounds[1].item()
+
+    def icdf(self, u):
+        return self.base.icdf(self.u_low + u * (self.u_high - self.u_low)).clamp(self.low, self.high)
+
+    def cdf(self, t):
+        return ((self.base.cdf(t) - self.u_low) / (self.u_high - self.u_low)).clamp(0, 1)
+
+
+class PartialRange(TimestepDistribution):
+    """
+    With probability `ratio` a whole batch is drawn from `partial` instead of `base` (partial training).
+    Both are sampled and the batch is selected on device, so that the choice never syncs with the host.
+    """
+    def __init__(self, base, partial, ratio):
+        self.base = base
+        self.partial = partial
+        self.ratio = ratio
+
+    def _select(self, t_base, t_partial, device, generator):
+        use_partial = th.rand((1,), device=device, generator=generator) < self.ratio
+        return th.where(use_partial, t_partial, t_base)
+
+    def sample(self, n, device=None, generator=None):
+        t_base, t_partial = self.base.sample(n, device, generator), self.partial.sample(n, device, generator)
+        return self._select(t_base, t_partial, device, generator)
+
+    def sample_stratified(self, n, k, device=None, generator=None):
+        t_base = self.base.sample_stratified(n, k, device, generator)
+        t_partial = self.partial.sample_stratified(n, k, device, generator)
+        return self._select(t_base, t_partial, device, generator)
+
+
+class AdaptiveImportance(TimestepDistribution):
+    """
+    Importance sampling of t from a running per-bucket loss estimate.
+
+    The quantiles of `base` are split into num_buckets equal-mass buckets. Every sample's loss is
+    accumulated into its bucket on device (no host sync); every `sync_every` steps sync() all-reduces the
+    accumulators over ranks and folds them into an EMA. Buckets are then drawn with probability
+    proportional to the smoothed loss ('loss'), its root mean square ('rms') or its standard deviation
+    ('std'), mixed with a uniform floor. Losses are reweighted by (1 / num_buckets) / p(bucket), so the
+    expected loss stays that of `base`. Until every bucket has min_count samples, sampling follows `base`.
+    """
+    def __init__(self, base=None, num_buckets=32, criterion='rms', momentum=0.9, uniform_mix=0.1, min_count=64, sync_every=100):
+        assert criterion in ('loss', 'rms', 'std'), f"unknown importance criterion {criterion}"
+        self.base = base if base is not None else Uniform()
+        self.num_buckets = num_buckets
+        self.criterion = criterion
+        self.momentum = momentum
+        self.uniform_mix = uniform_mix
+        self.min_count = min_count
+        self.sync_every = sync_every
+        self.probs = None
+
+    def _init(self, device):
+        if self.probs is None:
+            T = self.num_buckets
+            self.probs = th.full((T,), 1.0 / T, device=device)
+            self.loss_mean = th.zeros(T, device=device)
+            self.loss_sq = th.zeros(T, device=device)
+            self.count = th.zeros(T, device=device)
+            # local (count, sum, sum of squares) since the last sync
+            self._local = th.zeros(3, T, device=device)
+        if self.probs.device != th.device(device):
+            for name in ('probs', 'loss_mean', 'loss_sq', 'count', '_local'):
+                setattr(self, name, getattr(self, name).to(device))
+
+    def bucket(self, t):
+        return (self.base.cdf(t) * self.num_buckets).long().clamp(0, self.num_buckets - 1)
+
+    def icdf(self, u):
+        self._init(u.device)
+        cdf = th.cumsum(self.probs, dim=0)
+        bucket = th.searchsorted(cdf, u.contiguous(), right=True).clamp(max=self.num_buckets - 1)
+        p = self.probs[bucket]
+        within = ((u - (cdf[bucket] - p)) / p).clamp(0, 1)
+        return self.base.icdf((bucket + within) / self.num_buckets)
+
+    def weights(self, t):
+        self._init(t.device)
+        return (1.0 / self.num_buckets) / self.probs[self.bucket(t)]
+
+    def update(self, t, losses):
+        self._init(t.device)
+        bucket = self.bucket(t)
+        losses = losses.detach().float()
+        self._local[0].index_add_(0, bucket, th.ones_like(losses))
+        self._local[1].index_add_(0, bucket, losses)
+        self._local[2].index_add_(0, bucket, losses ** 2)
+
+    @th.no_grad()
+    def sync(self):
+        """
+        Merge the accumulated losses of all ranks into the estimate and recompute the bucket probabilities.
+        Has to be called on all ranks.
+        """
+        if self.probs is None:
+            return
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self._local, op=dist.ReduceOp.SUM)
+        count, total, total_sq = self._local
+        seen = count > 0
+        mean, mean_sq = total / count.clamp(min=1), total_sq / count.clamp(min=1)
+        first = seen & (self.count == 0)
+        m = self.momentum
+        self.loss_mean = th.where(first, mean, th.where(seen, m * self.loss_mean + (1 - m) * mean, self.loss_mean))
+        self.loss_sq = th.where(first, mean_sq, th.where(seen, m * self.loss_sq + (1 - m) * mean_sq, self.loss_sq))
+        self.count += count
+        self._local.zero_()
+
+        if bool((self.count >= self.min_count).all()):
+            if self.criterion == 'loss':
+                score = self.loss_mean
+            elif self.criterion == 'rms':
+                score = self.loss_sq.sqrt()
+            else:
+                score = (self.loss_sq - self.loss_mean ** 2).clamp(min=0).sqrt()
+            score = score.clamp(min=1e-12)
+            self.probs = (1 - self.uniform_mix) * score / score.sum() + self.uniform_mix / self.num_buckets
+
+    def summary(self):
+        """Bucket upper edges in t, bucket probabilities and loss estimates, for logging."""
+        if self.probs is None:
+            return None
+        edges = th.arange(1, self.num_buckets + 1, dtype=th.float64) / self.num_buckets
+        return dict(
+            edges=self.base.icdf(edges.clamp(max=1 - 1e-6)).tolist(),
+            probs=self.probs.tolist(),
+            loss=self.loss_mean.tolist(),
+        )
+
+    def state_dict(self):
+        if self.probs is None:
+            return {}
+        return {name: getattr(self, name).cpu() for name in ('probs', 'loss_mean', 'loss_sq', 'count')}
+
+    def load_state_dict(self, state):
+        if not state:
+            return
+        self._init(state['probs'].device)
+        for name, value in state.items():
+            setattr(self, name, value.to(self.probs.device))
+
+
+def create_timestep_distribution(name='uniform', **kwargs):
+    """
+    Build a timestep distribution from config, optionally truncated to [low, high].
+      name: uniform | logit_normal | mode | adaptive
+      logit_normal: mu (shift), sigma
+      mode: scale
+      adaptive: base (a nested distribution config, default uniform), see AdaptiveImportance for the others
+    """
+    if name == 'adaptive':
+        base = kwargs.pop('base', None)
+        base = create_timestep_distribution(**base) if base is not None else None
+        return AdaptiveImportance(base=base, **kwargs)
+    low, high = kwargs.pop('low', None), kwargs.pop('high', None)
+    distributions = {
+        'uniform': Uniform,
+        'logit_normal': LogitNormal,
+        'mode': ModeSampling,
+    }
+    assert name in distributions, f"unknown timestep distribution {name}, choose from {list(distributions)}"
+    dist = distributions[name](**kwargs)
+    if low is not None or high is not None:
+        dist = Truncated(dist, 0.0 if low is None else low, 1.0 if high is None else high)
+    return dist
@@ -5,9 +5,11 @@ import logging
 import enum
 
 from . import path
-from .utils import EasyDict, log_state, mean_flat
+from .utils import EasyDict, log_state, mean_flat, masked_mean_flat
 from .integrators import ode, sde
-from scipy.stats import norm
+from .solvers import native_ode, NATIVE_SOLVERS, adaptive_ode, ADAPTIVE_SOLVERS
+from .timesteps import Uniform
+from .losses import linear_xt, fused_velocity_losses
 
 class ModelType(enum.Enum):
     """
@@ -48,10 +50,10 @@ class Transport:
         train_eps,
         sample_eps,
         use_cosine_loss=False,
-        use_lognorm=False,
-        partitial_train=None,
-        partial_ratio=1.0,
-        shift_lg=False,
+        timestep_dist=None,
+        seed=None,
+        samples_per_latent=1,
+        fused_loss=False,
     ):
         path_options = {
             PathType.LINEAR: path.ICPlan,
@@ -65,10 +67,16 @@ class Transport:
         self.train_eps = train_eps
         self.sample_eps = sample_eps
         self.use_cosine_loss = use_cosine_loss
-        self.use_lognorm = use_lognorm
-        self.partitial_train = partitial_train
-        self.partial_ratio = partial_ratio
-        self.shift_lg = shift_lg
+        # distribution of training timesteps, see transport/timesteps.py
+        self.timestep_dist = timestep_dist if timestep_dist is not None else Uniform()
+        self.seed = seed
+        self._generator = None
+        self.samples_per_latent = samples_per_latent
+        # single-pass MSE + cosine objective, see transport/losses.py
+        self.fused_loss = fused_loss
+        if fused_loss:
+            assert path_type == PathType.LINEAR and model_type == ModelType.VELOCITY, \
+                "the fused loss is only implemented for the linear path with velocity prediction"
 
     def prior_logp(self, z):
         '''
@@ -110,30 +118,19 @@ class Transport:
 
         return t0, t1
 
-    def sample_logit_normal(self, mu, sigma, size=1):
-        # Generate samples from the normal distribution
-        samples = norm.rvs(loc=mu, scale=sigma, size=size)
-        
-        # Transform samples to be in the range (0, 1) using the logistic function
-        samples = 1 / (1 + np.exp(-samples))
-
-        # Numpy to Tensor
-        samples = th.tensor(samples, dtype=th.float32)
-
-        return samples
-
-    def sample_in_range(self, mu, sigma, target_size, range_min=0, range_max=0.5):
-        samples = []
-        while len(samples) < target_size:
-            generated_samples = self.sample_logit_normal(mu, sigma, size=target_size)
-            filtered_samples = generated_samples[(generated_samples >= range_min) & (generated_samples <= range_max)]
-            samples.extend(filtered_samples)
-        
-        # If we have more than the target size, truncate the list
-        samples = samples[:target_size]
-        return th.tensor(samples)
-
-    def sample(self, x1, sp_timesteps=None, shifted_mu=0):
+    def get_generator(self, device):
+        """
+        Seeded generator for the timesteps on `device`, None (global RNG) without a seed.
+        """
+        if self.seed is None:
+            return None
+        device = th.device(device)
+        if self._generator is None or self._generator.device != device:
+            self._generator = th.Generator(device=device)
+            self._generator.manual_seed(self.seed)
+        return self._generator
+
+    def sample(self, x1, sp_timesteps=None):
         """Sampling x0 & t based on shape of x1 (if needed)
           Args:
             x1 - data point; [batch, *dim]
@@ -141,26 +138,17 @@ class Transport:
         
         x0 = th.randn_like(x1)
         t0, t1 = self.check_interval(self.train_eps, self.sample_eps)
-        if not self.use_lognorm:
-            if self.partitial_train is not None and th.rand(1) < self.partial_ratio:
-                t = th.rand((x1.shape[0],)) * (self.partitial_train[1] - self.partitial_train[0]) + self.partitial_train[0]
-            else:
-                t = th.rand((x1.shape[0],)) * (t1 - t0) + t0
+        generator = self.get_generator(x1.device)
+        if sp_timesteps is not None:
+            # overwrite t if sp_timesteps is provided (for validation)
+            t = Uniform(sp_timesteps[0], sp_timesteps[1]).sample(x1.shape[0], x1.device, generator)
         else:
-            # random < partial_ratio, then sample from the partial range
-            if not self.shift_lg:
-                if self.partitial_train is not None and th.rand(1) < self.partial_ratio:
-                    t = self.sample_in_range(0, 1, x1.shape[0], range_min=self.partitial_train[0], range_max=self.partitial_train[1])
-                else:
-                    t = self.sample_logit_normal(0, 1, size=x1.shape[0]) * (t1 - t0) + t0
+            if self.samples_per_latent > 1:
+                # x1 holds samples_per_latent consecutive copies of every latent, give each copy its own stratum of t
+                t = self.timestep_dist.sample_stratified(x1.shape[0], self.samples_per_latent, x1.device, generator)
             else:
-                assert self.partitial_train is None, "Shifted lognormal distribution is not compatible with partial training"
-                t = self.sample_logit_normal(shifted_mu, 1, size=x1.shape[0]) * (t1 - t0) + t0
-        
-        # overwrite t if sp_timesteps is provided (for validation)
-        if sp_timesteps is not None:
-            # uniform sampling between self.sp_timesteps[0] and self.sp_timesteps[1]
-            t = th.rand((x1.shape[0],)) * (sp_timesteps[1] - sp_timesteps[0]) + sp_timesteps[0]
+                t = self.timestep_dist.sample(x1.shape[0], x1.device, generator)
+            t = t * (t1 - t0) + t0
 
         t = t.to(x1)
         return t, x0, x1
@@ -172,29 +160,52 @@ class Transport:
         x1, 
         model_kwargs=None,
         sp_timesteps=None,
-        shifted_mu=0,
+        loss_mask=None,
     ):
         """Loss for training the score model
         Args:
         - model: backbone model; could be score, noise, or velocity
         - x1: datapoint
         - model_kwargs: additional arguments for the model
+        - loss_mask: optional (B, 1, H, W) mask, losses are averaged over positions where it is 1 (masked-token training)
         """
         if model_kwargs == None:
             model_kwargs = {}
+        if self.samples_per_latent > 1:
+            # reuse every latent for several (t, x0) pairs, amortizes data loading and host-to-device copies
+            K, B = self.samples_per_latent, x1.shape[0]
+            x1 = x1.repeat_interleave(K, dim=0)
+            model_kwargs = {
+                k: v.repeat_interleave(K, dim=0) if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B else v
+                for k, v in model_kwargs.items()
+            }
+            if loss_mask is not None:
+                loss_mask = loss_mask.repeat_interleave(K, dim=0)
+        if loss_mask is None:
+            reduce = mean_flat
+        else:
+            reduce = lambda x: masked_mean_flat(x, loss_mask)
         
-        t, x0, x1 = self.sample(x1, sp_timesteps, shifted_mu)
-        t, xt, ut = self.path_sampler.plan(t, x0, x1)
+        t, x0, x1 = self.sample(x1, sp_timesteps)
+        if self.fused_loss:
+            # ut = x1 - x0 is never materialized
+            xt = linear_xt(t, x0, x1)
+        else:
+            t, xt, ut = self.path_sampler.plan(t, x0, x1)
         model_output = model(xt, t, **model_kwargs)
         B, *_, C = xt.shape
         assert model_output.size() == (B, *xt.size()[1:-1], C)
 
         terms = {}
         terms['pred'] = model_output
-        if self.model_type == ModelType.VELOCITY:
-            terms['loss'] = mean_flat(((model_output - ut) ** 2))
+        if self.fused_loss:
+            terms['loss'], cos_loss = fused_velocity_losses(model_output, x0, x1, loss_mask)
+            if self.use_cosine_loss:
+                terms['cos_loss'] = cos_loss
+        elif self.model_type == ModelType.VELOCITY:
+            terms['loss'] = reduce(((model_output - ut) ** 2))
             if self.use_cosine_loss:
-                terms['cos_loss'] = mean_flat(1 - th.nn.functional.cosine_similarity(model_output, ut, dim=1))
+                terms['cos_loss'] = reduce((1 - th.nn.functional.cosine_similarity(model_output, ut, dim=1)).unsqueeze(1))
         else: 
             _, drift_var = self.path_sampler.compute_drift(xt, t)
             sigma_t, _ = self.path_sampler.compute_sigma_t(path.expand_t_like_x(t, xt))
@@ -208,9 +219,20 @@ class Transport:
                 raise NotImplementedError()
             
             if self.model_type == ModelType.NOISE:
-                terms['loss'] = mean_flat(weight * ((model_output - x0) ** 2))
+                terms['loss'] = reduce(weight * ((model_output - x0) ** 2))
             else:
-                terms['loss'] = mean_flat(weight * ((model_output * sigma_t + x0) ** 2))
+                terms['loss'] = reduce(weight * ((model_output * sigma_t + x0) ** 2))
+
+        if sp_timesteps is None:
+            # adaptive timestep distributions learn from the raw losses and reweight them to stay unbiased
+            t0, t1 = self.check_interval(self.train_eps, self.sample_eps)
+            t_unit = (t - t0) / (t1 - t0)
+            self.timestep_dist.update(t_unit, terms['loss'])
+            weights = self.timestep_dist.weights(t_unit)
+            if weights is not None:
+                terms['loss'] = terms['loss'] * weights
+                if 'cos_loss' in terms:
+                    terms['cos_loss'] = terms['cos_loss'] * weights
                 
         return terms
     
@@ -408,6 +430,8 @@ class Sampler:
         """returns a sampling function with given ODE settings
         Args:
         - sampling_method: type of sampler used in solving the ODE; default to be Dopri5
+            - euler, heun, midpoint, dpm++2m: native fixed-step solvers, see transport/solvers.py
+            - others: passed to torchdiffeq
         - num_steps: 
             - fixed solver (Euler, Heun): the actual number of integration steps performed
             - adaptive solver (Dopri5): the number of datapoints saved during integration; produced by interpolation
@@ -429,6 +453,20 @@ class Sampler:
             last_step_size=0.0,
         )
 
+        if sampling_method in NATIVE_SOLVERS:
+            if sampling_method == "dpm++2m":
+                assert type(self.transport.path_sampler) in [path.ICPlan] and not reverse, \
+                    "dpm++2m is only implemented for the Linear path in forward time"
+            _ode = native_ode(
+                drift=drift,
+                t0=t0,
+                t1=t1,
+                sampler_type=sampling_method,
+                num_steps=num_steps,
+                timestep_shift=timestep_shift,
+            )
+            return _ode.sample
+
         _ode = ode(
             drift=drift,
             t0=t0,
@@ -442,6 +480,51 @@ class Sampler:
         
         return _ode.sample
 
+    def sample_ode_adaptive(
+        self,
+        *,
+        sampling_method="bosh3",
+        num_steps=50,
+        atol=1e-6,
+        rtol=1e-3,
+        reverse=False,
+    ):
+        """returns a per-sample adaptive ODE solver, see transport/solvers.py adaptive_ode
+        Args:
+        - sampling_method: embedded Runge-Kutta pair, heun_euler, bosh3 or dopri5
+        - num_steps: sets the initial step size (t1 - t0) / num_steps
+        - atol: absolute error tolerance for the solver
+        - rtol: relative error tolerance for the solver
+        - reverse: whether solving the ODE in reverse (data to noise); default to False
+        Returns:
+        - the solver, .sample(x, model, **model_kwargs) for a fixed batch and
+          .stream(init_fn, num_samples, batch_size, model, **model_kwargs) with refill
+        """
+        assert sampling_method in ADAPTIVE_SOLVERS, f"Adaptive solver {sampling_method} not implemented."
+        if reverse:
+            drift = lambda x, t, model, **kwargs: self.drift(x, th.ones_like(t) * (1 - t), model, **kwargs)
+        else:
+            drift = self.drift
+
+        t0, t1 = self.transport.check_interval(
+            self.transport.train_eps,
+            self.transport.sample_eps,
+            sde=False,
+            eval=True,
+            reverse=reverse,
+            last_step_size=0.0,
+        )
+
+        return adaptive_ode(
+            drift=drift,
+            t0=t0,
+            t1=t1,
+            sampler_type=sampling_method,
+            atol=atol,
+            rtol=rtol,
+            first_step=(t1 - t0) / num_steps,
+        )
+
     def sample_ode_likelihood(
         self,
         *,
@@ -15,6 +15,14 @@ def mean_flat(x):
     """
     return th.mean(x, dim=list(range(1, len(x.size()))))
 
+def masked_mean_flat(x, mask):
+    """
+    Take the mean over all non-batch dimensions where mask (broadcastable to x) is 1.
+    """
+    dims = list(range(1, len(x.size())))
+    mask = mask.expand_as(x)
+    return th.sum(x * mask, dim=dims) / th.sum(mask, dim=dims).clamp(min=1)
+
 def log_state(state):
     result = []
     
@@ -1,6 +1,13 @@
+import os
+import sys
+
 import torch
 from torch import nn
 
+# the multi-tensor EMA update is shared with the DiT training in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+from models.ema import ForeachEMA
+
 
 class LitEma(nn.Module):
     def __init__(self, model, decay=0.9999, use_num_upates=True):
@@ -21,27 +28,48 @@ class LitEma(nn.Module):
                 self.register_buffer(s_name,p.clone().detach().data)
 
         self.collected_params = []
+        self._foreach_ema = None
+        # host copies of the scalar buffers, so that an update never reads a device tensor back
+        self._decay_host = float(decay)
+        self._num_updates_host = None
 
-    def forward(self,model):
-        decay = self.decay
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the buffers change, re-read the host copies on the next update
+        self._num_updates_host = None
+        super()._load_from_state_dict(*args, **kwargs)
 
-        if self.num_updates >= 0:
-            self.num_updates += 1
-            decay = min(self.decay,(1 + self.num_updates) / (10 + self.num_updates))
+    def _apply(self, fn, *args, **kwargs):
+        # moving the module replaces the buffer tensors, rebind the parameter lists on the next update
+        self._foreach_ema = None
+        return super()._apply(fn, *args, **kwargs)
 
-        one_minus_decay = 1.0 - decay
-
-        with torch.no_grad():
-            m_param = dict(model.named_parameters())
+    def _bind(self, model):
+        """Pair the trained parameters with their shadow buffers once, instead of rebuilding dicts every step"""
+        if self._foreach_ema is None or self._foreach_model is not model:
             shadow_params = dict(self.named_buffers())
-
-            for key in m_param:
-                if m_param[key].requires_grad:
-                    sname = self.m_name2s_name[key]
-                    shadow_params[sname] = shadow_params[sname].type_as(m_param[key])
-                    shadow_params[sname].sub_(one_minus_decay * (shadow_params[sname] - m_param[key]))
+            m_params, s_params = [], []
+            for key, param in model.named_parameters():
+                if param.requires_grad:
+                    m_params.append(param)
+                    s_params.append(shadow_params[self.m_name2s_name[key]])
                 else:
                     assert not key in self.m_name2s_name
+            self._foreach_ema = ForeachEMA.from_params(s_params, m_params)
+            self._foreach_model = model
+        return self._foreach_ema
+
+    def forward(self,model):
+        if self._num_updates_host is None:
+            self._decay_host = self.decay.item()
+            self._num_updates_host = int(self.num_updates.item())
+        decay = self._decay_host
+
+        if self._num_updates_host >= 0:
+            self._num_updates_host += 1
+            self.num_updates.add_(1)  # keep the buffer in step for checkpoints, without a sync
+            decay = min(decay, (1 + self._num_updates_host) / (10 + self._num_updates_host))
+
+        self._bind(model).update(decay)
 
     def copy_to(self, model):
         m_param = dict(model.named_parameters())